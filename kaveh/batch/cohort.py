@@ -0,0 +1,170 @@
+"""
+Copyright (c) 2018 Laboratory for Computational Motor Control, Johns Hopkins School of Medicine
+
+Author: Kaveh Karbasi <kkarbasi@berkeley.edu>
+
+Cohort-level spike time index built from batch outputs.
+
+A cohort index is a directory containing:
+    spike_times.f8  all spike times (s) of all files, as one flat memory-mappable float64 array
+    segments.npy    one row per (file, channel, unit kind) with the [start, stop) range of
+                    that unit's spike times in spike_times.f8
+    files.json      one metadata record per results file (source, channel, duration, SMR header)
+Queries only touch these three files, never the per-file results.
+"""
+
+import fnmatch
+import json
+import os
+import numpy as np
+from kaveh.sorting.results import load_results
+
+SPIKE_TIMES_FILE = 'spike_times.f8'
+SEGMENTS_FILE = 'segments.npy'
+FILES_FILE = 'files.json'
+
+UNIT_KINDS = ('spikes', 'cs')
+
+SEGMENT_DTYPE = np.dtype([('file_id', 'int32'), ('channel', 'int16'), ('kind', 'int8'),
+                          ('start', 'int64'), ('stop', 'int64')])
+
+
+def build_cohort_index(result_files, directory):
+    """
+    Builds a cohort index in directory from a list of results files (see kaveh.sorting.results)
+    Spike times are streamed to disk file by file, so memory use is bounded by the largest file.
+    Returns the opened CohortIndex
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    files = []
+    segments = []
+    position = 0
+    with open(os.path.join(directory, SPIKE_TIMES_FILE), 'wb') as fp:
+        for file_id, filename in enumerate(result_files):
+            results = load_results(filename, fields=('dt', 'signal_size', 'spike_indices',
+                                                     'cs_indices', 'metadata'))
+            metadata = results['metadata']
+            channel = int(metadata.get('channel', 0))
+            record = {'file_id': file_id,
+                      'results': filename,
+                      'dt': results['dt'],
+                      'duration': results['signal_size'] * results['dt']}
+            record.update(metadata)
+            record['channel'] = channel
+            files.append(record)
+            for kind, field in enumerate(('spike_indices', 'cs_indices')):
+                times = np.sort(results[field]) * results['dt']
+                times.astype('float64').tofile(fp)
+                segments.append((file_id, channel, kind, position, position + times.size))
+                position = position + times.size
+    np.save(os.path.join(directory, SEGMENTS_FILE), np.array(segments, dtype=SEGMENT_DTYPE))
+    with open(os.path.join(directory, FILES_FILE), 'w') as fp:
+        json.dump(files, fp)
+    return CohortIndex(directory)
+
+
+class CohortIndex:
+    """ Read-only, memory-mapped view of a cohort index built by build_cohort_index"""
+    def __init__(self, directory):
+        """
+        Object constructor
+        """
+        self.directory = directory
+        with open(os.path.join(directory, FILES_FILE), 'r') as fp:
+            self.files = json.load(fp)
+        self.segments = np.load(os.path.join(directory, SEGMENTS_FILE))
+        spike_times_fn = os.path.join(directory, SPIKE_TIMES_FILE)
+        if os.path.getsize(spike_times_fn) > 0:
+            self.spike_times_all = np.memmap(spike_times_fn, dtype='float64', mode='r')
+        else:
+            self.spike_times_all = np.zeros((0,), dtype='float64')  # Cannot memory-map an empty file
+        # Lookup table of (file_id, kind) -> segment row
+        self._segment_lookup = np.full((len(self.files), len(UNIT_KINDS)), -1, dtype='int64')
+        self._segment_lookup[self.segments['file_id'], self.segments['kind']] = np.arange(self.segments.size)
+
+    def __len__(self):
+        return len(self.files)
+
+    def select(self, **patterns):
+        """
+        Returns the file ids whose metadata matches all patterns
+        Values are matched with fnmatch against the string representation of the field,
+        nested header fields are addressed with '__', e.g.
+        select(source='*O89*', header__creator='CED*')
+        """
+        file_ids = []
+        for record in self.files:
+            for key, pattern in patterns.items():
+                value = record
+                for part in key.split('__'):
+                    value = value.get(part) if isinstance(value, dict) else None
+                if value is None or not fnmatch.fnmatch(str(value), str(pattern)):
+                    break
+            else:
+                file_ids.append(record['file_id'])
+        return np.array(file_ids, dtype='int64')
+
+    def spike_times(self, file_id, kind='spikes'):
+        """
+        Returns the (memory-mapped) sorted spike times (s) of a file
+        kind: 'spikes' or 'cs'
+        """
+        segment = self.segments[self._segment_lookup[file_id, _kind_index(kind)]]
+        return self.spike_times_all[segment['start']:segment['stop']]
+
+    def counts(self, kind='spikes', file_ids=None):
+        """
+        Returns the number of spikes of each file
+        """
+        rows = self._rows(kind, file_ids)
+        return self.segments['stop'][rows] - self.segments['start'][rows]
+
+    def firing_rates(self, kind='spikes', file_ids=None):
+        """
+        Returns the mean firing rate (Hz) of each file
+        """
+        if file_ids is None:
+            file_ids = np.arange(len(self.files))
+        durations = np.array([self.files[i]['duration'] for i in file_ids], dtype='float64')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.counts(kind, file_ids) / durations
+
+    def spikes_near(self, events, window, kind='spikes', file_ids=None):
+        """
+        Finds the spikes that occur within a window around events
+        events: either an array of event times (s) used for every file, or a dictionary
+        mapping file_id to that file's array of event times
+        window: (start, stop) offsets (s) relative to the events, or a single value w for (-w, w)
+        Returns a dictionary mapping file_id to a tuple (relative_times, event_indices),
+        where relative_times are the spike times relative to the event with index event_indices
+        """
+        if np.isscalar(window):
+            window = (-window, window)
+        if file_ids is None:
+            file_ids = events.keys() if isinstance(events, dict) else range(len(self.files))
+        near = {}
+        for file_id in file_ids:
+            file_events = events[file_id] if isinstance(events, dict) else events
+            file_events = np.atleast_1d(np.asarray(file_events, dtype='float64'))
+            times = self.spike_times(file_id, kind)
+            lo = np.searchsorted(times, file_events + window[0], side='left')
+            hi = np.searchsorted(times, file_events + window[1], side='right')
+            num = hi - lo
+            event_indices = np.repeat(np.arange(file_events.size), num)
+            # Index of each selected spike: its window start plus its position in the window
+            offsets = np.arange(event_indices.size) - np.repeat(np.cumsum(num) - num, num)
+            spike_indices = lo[event_indices] + offsets
+            near[file_id] = (np.asarray(times[spike_indices]) - file_events[event_indices], event_indices)
+        return near
+
+    def _rows(self, kind, file_ids):
+        if file_ids is None:
+            file_ids = np.arange(len(self.files))
+        return self._segment_lookup[np.asarray(file_ids, dtype='int64'), _kind_index(kind)]
+
+
+def _kind_index(kind):
+    if kind not in UNIT_KINDS:
+        raise ValueError('Unknown spike kind {}'.format(kind))
+    return UNIT_KINDS.index(kind)
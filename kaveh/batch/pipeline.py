@@ -0,0 +1,188 @@
+"""
+Copyright (c) 2018 Laboratory for Computational Motor Control, Johns Hopkins School of Medicine
+
+Author: Kaveh Karbasi <kkarbasi@berkeley.edu>
+
+Pipelined batch spike sorting.
+
+Reading, sorting and writing run as three overlapping stages driven by an asyncio
+event loop in the main process:
+    read:  reader tasks load the next files' ADC channel into shared memory (thread pool),
+           at most `prefetch` loaded files wait for a worker, which bounds memory use
+    sort:  worker processes attach to the shared voltage (no pickling of the signal)
+           and return the compact results (see kaveh.sorting.results)
+    write: writer tasks save the results in a background thread pool
+so disk/network I/O is hidden behind the CPU-bound sorting.
+A file whose sorting takes longer than the timeout is reported failed ('timeout') and its
+worker is left out of the rest of the batch, the stuck workers are terminated at the end.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from smr import File
+from kaveh.sorting.spikesorter import SimpleSpikeSorter
+from kaveh.sorting.results import collect_results, write_results
+from kaveh.batch.progress import NullReporter
+from kaveh.batch.shared import shared_copy
+
+
+def read_channel(input_fn, channel=0, backend='shm'):
+    """
+    Reads one ADC channel of an SMR file into shared memory
+    backend: 'shm' or 'memmap' (see kaveh.batch.shared)
+    Returns (voltage shared array, dt, metadata)
+    """
+    smr_content = File(input_fn)
+    try:
+        voltage_chan = smr_content.get_channel(channel)
+        voltage = shared_copy(voltage_chan.data, backend)
+        metadata = {'source': input_fn, 'channel': voltage_chan.channel_number,
+                    'channel_title': voltage_chan.title, 'header': smr_content.header()}
+    finally:
+        smr_content.close()
+    return voltage, voltage_chan.dt, metadata
+
+
+def sort_shared(voltage, dt, settings, waveform_dtype='int16', metadata=None):
+    """
+    Runs a SimpleSpikeSorter on a shared voltage signal (executed in a worker process)
+    settings: dictionary of sorter attributes to set before running
+    Returns (results dictionary, sorter stage timings)
+    """
+    sss = SimpleSpikeSorter(voltage, dt)  # The detection processes reuse the shared voltage
+    for key in settings:
+        setattr(sss, key, settings[key])
+    sss.run()
+    results = collect_results(sss, waveform_dtype, metadata)
+    timings = sss.timings
+    del sss  # Drop the views of the shared block before closing it
+    voltage.close()
+    return results, timings
+
+
+def run_pipeline(inputs, n_workers, settings=None, channel=0, prefetch=2, readers=1, writers=1,
+                 waveform_dtype='int16', reporter=None, backend='shm', timeout=9600):
+    """
+    Sorts a list of (input_fn, output_fn) pairs with overlapping read, sort and write stages
+    n_workers: number of sorting processes
+    settings: dictionary of sorter attributes (e.g. {'cs_cov_type': 'tied'})
+    prefetch: maximum number of files read ahead of the workers
+    readers, writers: number of concurrent file reads and writes
+    reporter: optional ProgressReporter (see kaveh.batch.progress)
+    backend: how the voltage is shared with the workers, 'shm' or 'memmap' (see kaveh.batch.shared)
+    timeout: maximum time (s) to sort one file, None for no limit
+    Returns the number of files that failed
+    """
+    if settings is None:
+        settings = {}
+    if reporter is None:
+        reporter = NullReporter()
+    return asyncio.run(_pipeline(list(inputs), n_workers, settings, channel, prefetch,
+                                 readers, writers, waveform_dtype, reporter, backend, timeout))
+
+
+def _terminate_workers(pool):
+    """
+    Shuts a process pool down without waiting for the running tasks (sorts that timed out)
+    """
+    if hasattr(pool, 'terminate_workers'):  # Python >= 3.14
+        pool.terminate_workers()
+        return
+    processes = list((pool._processes or {}).values())  # Cleared by shutdown
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+
+async def _pipeline(inputs, n_workers, settings, channel, prefetch, readers, writers,
+                    waveform_dtype, reporter, backend, timeout):
+    loop = asyncio.get_running_loop()
+    pending = iter(inputs)
+    loaded = asyncio.Queue(maxsize=prefetch)
+    sorted_results = asyncio.Queue(maxsize=n_workers)
+    failures = [0]
+    sorting = [n_workers]  # Sorters still running, a sorter whose worker is stuck stops
+    timed_out = [0]
+
+    def fail(input_fn, error):
+        print('Failed {}: {}'.format(input_fn, error))
+        reporter.failed(input_fn, error)
+        failures[0] += 1
+
+    async def read(io_pool):
+        for input_fn, output_fn in pending:  # Shared iterator, each file is read by one reader
+            print('reading {} ...'.format(input_fn))
+            try:
+                reporter.started(input_fn, os.path.getsize(input_fn))
+                with reporter.stage(input_fn, 'read'):
+                    voltage, dt, metadata = await loop.run_in_executor(io_pool, read_channel,
+                                                                       input_fn, channel, backend)
+            except Exception as e:
+                fail(input_fn, e)
+                continue
+            await loaded.put((input_fn, output_fn, voltage, dt, metadata))
+
+    async def sort(sort_pool):
+        while True:
+            item = await loaded.get()
+            if item is None:
+                loaded.put_nowait(None)  # Pass the end of the inputs on to the other sorters
+                return
+            input_fn, output_fn, voltage, dt, metadata = item
+            samples = voltage.array.size
+            try:
+                if samples == 0:
+                    print('No data in channel for {}'.format(input_fn))
+                    reporter.finished(input_fn, 0)
+                    continue
+                print('processing {}...'.format(input_fn))
+                results, timings = await asyncio.wait_for(
+                    loop.run_in_executor(sort_pool, sort_shared, voltage, dt, settings, waveform_dtype, metadata),
+                    timeout)
+            except asyncio.TimeoutError:
+                fail(input_fn, 'timeout')
+                timed_out[0] += 1
+                # The worker is still busy with this file, leave it to the other sorters so
+                # the next files do not wait for it (and time out) in the pool's queue
+                if sorting[0] > 1:
+                    sorting[0] -= 1
+                    return
+                continue
+            except Exception as e:
+                fail(input_fn, e)
+                continue
+            finally:
+                voltage.unlink()
+            for stage in timings:
+                reporter.stage_time(input_fn, stage, timings[stage])
+            await sorted_results.put((input_fn, output_fn, results, samples))
+
+    async def write(io_pool):
+        while True:
+            item = await sorted_results.get()
+            if item is None:
+                return
+            input_fn, output_fn, results, samples = item
+            print('writing {} ...'.format(output_fn))
+            try:
+                with reporter.stage(input_fn, 'write'):
+                    await loop.run_in_executor(io_pool, write_results, output_fn, results)
+            except Exception as e:
+                fail(input_fn, e)
+                continue
+            reporter.finished(input_fn, samples)
+
+    with ThreadPoolExecutor(readers) as read_pool, ThreadPoolExecutor(writers) as write_pool, \
+            ProcessPoolExecutor(n_workers) as sort_pool:
+        sorters = [asyncio.ensure_future(sort(sort_pool)) for i in range(n_workers)]
+        writer_tasks = [asyncio.ensure_future(write(write_pool)) for i in range(writers)]
+        await asyncio.gather(*[read(read_pool) for i in range(readers)])
+        await loaded.put(None)
+        await asyncio.gather(*sorters)
+        if timed_out[0] > 0:
+            _terminate_workers(sort_pool)
+        for i in range(writers):
+            await sorted_results.put(None)
+        await asyncio.gather(*writer_tasks)
+    return failures[0]
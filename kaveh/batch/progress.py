@@ -0,0 +1,328 @@
+"""
+Copyright (c) 2018 Laboratory for Computational Motor Control, Johns Hopkins School of Medicine
+
+Author: Kaveh Karbasi <kkarbasi@berkeley.edu>
+
+Live progress and throughput metrics for batch runs.
+
+The ProgressTracker lives in the main process. Worker processes report events
+(file started, stage timings, file finished/failed) through a ProgressReporter,
+which only holds a multiprocessing queue and can therefore be passed to joblib
+or multiprocessing workers. The tracker periodically rewrites a status JSON file
+and can serve the same numbers as Prometheus text on a local HTTP port.
+"""
+
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import psutil
+
+STAGE_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def peak_rss():
+    """
+    Returns the memory high-water mark (bytes) of the calling process
+    """
+    try:
+        import resource
+    except ImportError:  # Not available on Windows, fall back to the current resident size
+        return psutil.Process().memory_info().rss
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024  # kB on Linux
+
+
+class ProgressReporter:
+    """ Picklable handle that workers use to report progress to a ProgressTracker"""
+    def __init__(self, queue):
+        """
+        Object constructor
+        """
+        self.queue = queue
+
+    def _send(self, event, filename, **kw):
+        kw.update({'event': event, 'filename': filename, 'pid': os.getpid(),
+                   'time': time.time(), 'peak_rss': peak_rss()})
+        self.queue.put(kw)
+
+    def started(self, filename, nbytes=0):
+        """
+        Reports that a worker started processing filename (nbytes: size of the input)
+        """
+        self._send('started', filename, nbytes=nbytes)
+
+    def stage_time(self, filename, stage, seconds):
+        """
+        Reports the duration of a processing stage
+        """
+        self._send('stage', filename, stage=stage, seconds=seconds)
+
+    @contextmanager
+    def stage(self, filename, stage):
+        """
+        Context manager that times a processing stage:
+        with reporter.stage(filename, 'read'):
+            ...
+        """
+        start = time.time()
+        yield
+        self.stage_time(filename, stage, time.time() - start)
+
+    def finished(self, filename, samples=0):
+        """
+        Reports that filename was processed (samples: number of samples sorted)
+        """
+        self._send('finished', filename, samples=samples)
+
+    def failed(self, filename, error=''):
+        """
+        Reports that processing filename failed
+        """
+        self._send('failed', filename, error=str(error))
+
+
+class NullReporter(ProgressReporter):
+    """ Reporter that drops all events (used when no tracker is running)"""
+    def __init__(self):
+        """
+        Object constructor
+        """
+        ProgressReporter.__init__(self, None)
+
+    def _send(self, event, filename, **kw):
+        pass
+
+
+class ProgressTracker:
+    """ Collects progress events of a batch run and publishes them"""
+    def __init__(self, total_files, status_file=None, port=None, interval=10.0, host='127.0.0.1'):
+        """
+        Object constructor
+        total_files: number of files in the batch
+        status_file: path of the status JSON file, rewritten every interval seconds
+        port: if not None, serve /metrics (Prometheus text) and /status (JSON) on host:port
+        """
+        self.total_files = total_files
+        self.status_file = status_file
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self.start_time = time.time()
+        self.done = 0
+        self.failed = 0
+        self.in_flight = {}  # filename -> (start time, pid)
+        self.bytes_processed = 0
+        self.samples_processed = 0
+        self.stage_times = {}  # stage name -> list of durations (s)
+        self.worker_peak_rss = {}  # pid -> bytes
+        self.failures = []
+        self._failed_files = set()  # Late events of these files (e.g. after a timeout) are ignored
+        self._pending_bytes = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._manager = None
+        self._threads = []
+        self._server = None
+        self.reporter = None
+
+    def start(self):
+        """
+        Starts collecting events and publishing the status
+        """
+        self._manager = multiprocessing.Manager()
+        self.reporter = ProgressReporter(self._manager.Queue())
+        self._threads = [threading.Thread(target=self._collect, daemon=True),
+                         threading.Thread(target=self._publish, daemon=True)]
+        if self.port is not None:
+            self._server = ThreadingHTTPServer((self.host, self.port), _metrics_handler(self))
+            self._threads.append(threading.Thread(target=self._server.serve_forever, daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """
+        Drains outstanding events, writes the final status and shuts everything down
+        """
+        self.reporter.queue.put(None)  # Sentinel for the collector
+        self._stop.set()
+        for thread in self._threads[:2]:
+            thread.join()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        self._write_status_file()
+        self._manager.shutdown()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _collect(self):
+        while True:
+            message = self.reporter.queue.get()
+            if message is None:
+                return
+            self.record(message)
+
+    def _publish(self):
+        while not self._stop.wait(self.interval):
+            self._write_status_file()
+
+    def record(self, message):
+        """
+        Updates the counters with a message sent by a ProgressReporter
+        """
+        filename = message['filename']
+        with self._lock:
+            pid = message['pid']
+            self.worker_peak_rss[pid] = max(self.worker_peak_rss.get(pid, 0), message['peak_rss'])
+            if message['event'] == 'started':
+                self._failed_files.discard(filename)
+                self.in_flight[filename] = (message['time'], pid)
+                self._pending_bytes[filename] = message['nbytes']
+            elif filename in self._failed_files:
+                return  # The file was given up on (with_timeout), its abandoned run is still reporting
+            elif message['event'] == 'stage':
+                self.stage_times.setdefault(message['stage'], []).append(message['seconds'])
+            elif message['event'] == 'finished':
+                self.in_flight.pop(filename, None)
+                self.done += 1
+                self.bytes_processed += self._pending_bytes.pop(filename, 0)
+                self.samples_processed += message['samples']
+            elif message['event'] == 'failed':
+                self._failed_files.add(filename)
+                self.in_flight.pop(filename, None)
+                self._pending_bytes.pop(filename, None)
+                self.failed += 1
+                self.failures.append({'filename': filename, 'error': message['error']})
+
+    def status(self):
+        """
+        Returns the current status as a (JSON-serializable) dictionary
+        """
+        with self._lock:
+            now = time.time()
+            elapsed = max(now - self.start_time, 1e-9)
+            stages = {}
+            for stage, durations in self.stage_times.items():
+                stages[stage] = {'count': len(durations), 'sum': float(np.sum(durations)),
+                                 'quantiles': {str(q): float(np.quantile(durations, q)) for q in STAGE_QUANTILES}}
+            in_flight = sorted(({'filename': filename, 'pid': pid, 'elapsed': now - start}
+                                for filename, (start, pid) in self.in_flight.items()),
+                               key=lambda x: -x['elapsed'])  # Stragglers first
+            return {'time': now,
+                    'elapsed': elapsed,
+                    'files_total': self.total_files,
+                    'files_done': self.done,
+                    'files_failed': self.failed,
+                    'files_in_flight': len(self.in_flight),
+                    'bytes_processed': self.bytes_processed,
+                    'samples_processed': self.samples_processed,
+                    'bytes_per_second': self.bytes_processed / elapsed,
+                    'samples_per_second': self.samples_processed / elapsed,
+                    'stages': stages,
+                    'peak_rss': max(list(self.worker_peak_rss.values()) + [peak_rss()]),
+                    'worker_peak_rss': {str(pid): rss for pid, rss in self.worker_peak_rss.items()},
+                    'in_flight': in_flight,
+                    'failures': list(self.failures)}
+
+    def metrics(self):
+        """
+        Returns the current status in the Prometheus text exposition format
+        """
+        status = self.status()
+        lines = []
+
+        def metric(name, kind, value, help_text, labels=None):
+            if labels is None:
+                lines.extend(['# HELP batch_{} {}'.format(name, help_text),
+                              '# TYPE batch_{} {}'.format(name, kind)])
+                lines.append('batch_{} {}'.format(name, value))
+            else:
+                lines.append('batch_{}{{{}}} {}'.format(name, labels, value))
+
+        metric('files_total', 'gauge', status['files_total'], 'Number of files in the batch')
+        metric('files_done_total', 'counter', status['files_done'], 'Number of processed files')
+        metric('files_failed_total', 'counter', status['files_failed'], 'Number of failed files')
+        metric('files_in_flight', 'gauge', status['files_in_flight'], 'Number of files being processed')
+        metric('bytes_processed_total', 'counter', status['bytes_processed'], 'Input bytes processed')
+        metric('samples_processed_total', 'counter', status['samples_processed'],
+               'Number of voltage samples sorted in the processed files')
+        metric('bytes_per_second', 'gauge', status['bytes_per_second'], 'Average input throughput')
+        metric('samples_per_second', 'gauge', status['samples_per_second'], 'Average sample throughput')
+        metric('peak_rss_bytes', 'gauge', status['peak_rss'], 'Memory high-water mark over all processes')
+        lines.extend(['# HELP batch_stage_seconds Duration of processing stages',
+                      '# TYPE batch_stage_seconds summary'])
+        for stage, summary in status['stages'].items():
+            for q, value in summary['quantiles'].items():
+                metric('stage_seconds', None, value, None, 'stage="{}",quantile="{}"'.format(stage, q))
+            metric('stage_seconds_sum', None, summary['sum'], None, 'stage="{}"'.format(stage))
+            metric('stage_seconds_count', None, summary['count'], None, 'stage="{}"'.format(stage))
+        lines.extend(['# HELP batch_worker_peak_rss_bytes Memory high-water mark of each worker',
+                      '# TYPE batch_worker_peak_rss_bytes gauge'])
+        for pid, rss in status['worker_peak_rss'].items():
+            metric('worker_peak_rss_bytes', None, rss, None, 'pid="{}"'.format(pid))
+        return '\n'.join(lines) + '\n'
+
+    def _write_status_file(self):
+        if self.status_file is None:
+            return
+        temp_filename = self.status_file + '.tmp'
+        with open(temp_filename, 'w') as fp:
+            json.dump(self.status(), fp, indent=1)
+        os.replace(temp_filename, self.status_file)  # Readers never see a partial file
+
+
+def _metrics_handler(tracker):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith('/metrics'):
+                body = tracker.metrics().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path.startswith('/status'):
+                body = json.dumps(tracker.status()).encode('utf-8')
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # Keep the batch stdout log clean
+    return MetricsHandler
+
+
+def print_status(status_file):
+    """
+    Prints a human readable summary of a status file
+    """
+    with open(status_file, 'r') as fp:
+        status = json.load(fp)
+    print('Files: {} done, {} failed, {} in flight, {} total'.format(
+        status['files_done'], status['files_failed'], status['files_in_flight'], status['files_total']))
+    print('Throughput: {:.1f} MB/s, {:.0f} samples/s, peak memory {:.0f} MB'.format(
+        status['bytes_per_second'] / 1e6, status['samples_per_second'], status['peak_rss'] / 1e6))
+    for stage, summary in status['stages'].items():
+        print('Stage {}: n = {}, '.format(stage, summary['count']) +
+              ', '.join('p{:g} = {:.1f}s'.format(float(q) * 100, v) for q, v in summary['quantiles'].items()))
+    for entry in status['in_flight'][:5]:
+        print('In flight for {:.0f}s: {}'.format(entry['elapsed'], entry['filename']))
+    for entry in status['failures'][-5:]:
+        print('Failed: {} ({})'.format(entry['filename'], entry['error']))
+
+
+if __name__ == '__main__':
+    print_status(sys.argv[1])
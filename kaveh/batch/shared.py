@@ -0,0 +1,180 @@
+"""
+Copyright (c) 2018 Laboratory for Computational Motor Control, Johns Hopkins School of Medicine
+
+Author: Kaveh Karbasi <kkarbasi@berkeley.edu>
+
+Numpy arrays in shared memory that can be handed to worker processes without copying.
+
+Two backends share the same interface (array, close, unlink, pickling by name):
+    SharedArray  a multiprocessing.shared_memory block
+    MemmapArray  a memory-mapped file, by default in /dev/shm when it exists. Views of a
+                 MemmapArray stay valid after unlink, so results can be kept without a copy.
+"""
+
+import os
+import sys
+import tempfile
+from multiprocessing import shared_memory
+import numpy as np
+
+BACKENDS = ('shm', 'memmap')
+
+
+def default_memmap_directory():
+    """
+    Returns /dev/shm (RAM backed) when available, otherwise the temporary directory
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def shared_array(shape, dtype, backend='shm', directory=None):
+    """
+    Creates a new shared array with the given backend ('shm' or 'memmap')
+    directory: location of the backing file of memmap arrays (see default_memmap_directory)
+    """
+    if backend == 'shm':
+        return SharedArray(shape, dtype)
+    elif backend == 'memmap':
+        return MemmapArray(shape, dtype, directory=directory)
+    raise ValueError('Unknown shared array backend {}'.format(backend))
+
+
+def shared_copy(x, backend='shm', directory=None):
+    """
+    Returns a shared array holding a copy of x
+    """
+    x = np.asarray(x)
+    shared = shared_array(x.shape, x.dtype, backend, directory)
+    shared.array[...] = x
+    return shared
+
+
+def unshare(shared):
+    """
+    Unlinks a shared array (owner only) and returns its contents as a regular array
+    Views of a MemmapArray stay valid after unlink and are returned without a copy
+    """
+    if isinstance(shared, MemmapArray):
+        array = shared.array
+    else:
+        array = np.array(shared.array)
+    shared.unlink()
+    return array
+
+
+class SharedArray:
+    """ A numpy array backed by a multiprocessing.shared_memory block
+
+    Pickling a SharedArray only sends the name, shape and dtype of the block, the
+    receiving process attaches to the same memory and gets a zero-copy view.
+    Only the creating process (the owner) may unlink the block.
+    """
+    def __init__(self, shape, dtype, name=None):
+        """
+        Object constructor
+        Creates a new block of the given shape and dtype, or attaches to the existing block name
+        """
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)  # Blocks cannot be empty
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.owner = True
+        else:
+            if sys.version_info >= (3, 13):
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            else:
+                self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def from_array(cls, x):
+        """
+        Creates a shared block holding a copy of x
+        """
+        x = np.asarray(x)
+        shared = cls(x.shape, x.dtype)
+        shared.array[...] = x
+        return shared
+
+    def __reduce__(self):
+        return (SharedArray, (self.shape, self.dtype.str, self.name))
+
+    def close(self):
+        """
+        Releases this process' view of the block
+        """
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        """
+        Closes and frees the block (owner only)
+        """
+        if not self.owner:
+            raise RuntimeError('Only the process that created {} can unlink it'.format(self.name))
+        self.close()
+        self.shm.unlink()
+
+
+class MemmapArray:
+    """ A numpy array backed by a memory-mapped (temporary) file
+
+    Pickling a MemmapArray only sends the file name, shape and dtype, the receiving
+    process maps the same file. Unlinking removes the file, but the mapping (and any
+    view of it) stays valid until the last view is released.
+    """
+    def __init__(self, shape, dtype, filename=None, directory=None):
+        """
+        Object constructor
+        Creates a new file of the given shape and dtype in directory, or maps the existing filename
+        """
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        if filename is None:
+            if directory is None:
+                directory = default_memmap_directory()
+            fd, filename = tempfile.mkstemp(prefix='kaveh_', suffix='.dat', dir=directory)
+            os.close(fd)
+            mode = 'w+'
+            self.owner = True
+        else:
+            mode = 'r+'
+            self.owner = False
+        self.name = filename
+        if int(np.prod(self.shape)) == 0:
+            self.array = np.zeros(self.shape, dtype=self.dtype)  # Empty files cannot be mapped
+        else:
+            self.array = np.memmap(filename, dtype=self.dtype, mode=mode, shape=self.shape)
+
+    @classmethod
+    def from_array(cls, x, directory=None):
+        """
+        Creates a memory-mapped file holding a copy of x
+        """
+        x = np.asarray(x)
+        shared = cls(x.shape, x.dtype, directory=directory)
+        shared.array[...] = x
+        return shared
+
+    def __reduce__(self):
+        return (MemmapArray, (self.shape, self.dtype.str, self.name))
+
+    def close(self):
+        """
+        Releases this object's reference to the mapping
+        """
+        self.array = None
+
+    def unlink(self):
+        """
+        Removes the backing file (owner only), existing views stay valid
+        """
+        if not self.owner:
+            raise RuntimeError('Only the process that created {} can unlink it'.format(self.name))
+        if os.path.exists(self.name):
+            os.remove(self.name)
@@ -0,0 +1,173 @@
+"""
+Copyright (c) 2018 Laboratory for Computational Motor Control, Johns Hopkins School of Medicine
+
+Author: Kaveh Karbasi <kkarbasi@berkeley.edu>
+
+Compact, fixed-schema storage for spike sorting results.
+
+Instead of pickling whole SimpleSpikeSorter objects (which ties the output to the
+class layout and drags along any arrays left on the object), only the sorting
+results are written to a compressed .npz archive. Every archive contains the same
+set of keys (see RESULT_FIELDS), so thousands of outputs can be read back without
+unpickling anything, and a single field (e.g. the spike indices) can be loaded
+without decompressing the waveforms.
+"""
+
+import json
+import numpy as np
+
+SCHEMA_VERSION = 1
+
+# Every results archive contains exactly these arrays
+RESULT_FIELDS = ('schema_version', 'dt', 'signal_size', 'spike_indices', 'cs_indices',
+                 'waveforms', 'waveform_indices', 'waveform_scale', 'features',
+                 'config', 'metadata')
+
+# Sorter attributes that are recorded in the 'config' field
+CONFIG_FIELDS = ('low_pass_filter_cutoff', 'high_pass_filter_cutoff', 'filter_order',
+                 'num_gmm_components', 'gmm_cov_type', 'pre_window', 'post_window',
+                 'minibatch_thresh', 'freq_range', 'cs_num_gmm_components', 'cs_cov_type',
+                 'post_cs_pause_time', 'cs_features', 'captured_variance')
+
+WAVEFORM_DTYPES = ('float64', 'float32', 'float16', 'int16')
+
+
+def collect_results(sorter, waveform_dtype='float32', metadata=None):
+    """
+    Extracts the sorting results of a SimpleSpikeSorter into a dictionary following RESULT_FIELDS.
+    Results the sorter has not computed (e.g. complex spikes when only detection was run)
+    are stored as empty arrays.
+    waveform_dtype: storage type of the aligned waveforms ('float64', 'float32', 'float16' or 'int16').
+    int16 waveforms are scaled to the full int16 range unless they are already integral
+    (e.g. raw ADC counts), the scale is stored in 'waveform_scale'.
+    metadata: an optional JSON-serializable dictionary describing the source of the data
+    """
+    if waveform_dtype not in WAVEFORM_DTYPES:
+        raise ValueError('Unknown waveform dtype {}'.format(waveform_dtype))
+    waveforms = np.asarray(getattr(sorter, 'aligned_spikes', np.zeros((0, 0))))
+    waveforms, scale = _encode_waveforms(waveforms, waveform_dtype)
+    features = np.asarray(getattr(sorter, 'features', np.zeros((0, 0))), dtype='float32')
+    config = {}
+    for field in CONFIG_FIELDS:
+        if hasattr(sorter, field):
+            value = getattr(sorter, field)
+            config[field] = list(value) if isinstance(value, tuple) else value
+    return {
+        'schema_version': np.int64(SCHEMA_VERSION),
+        'dt': np.float64(sorter.dt),
+        'signal_size': np.int64(sorter.signal_size),
+        'spike_indices': _index_array(getattr(sorter, 'spike_indices', None)),
+        'cs_indices': _index_array(getattr(sorter, 'cs_indices', None)),
+        'waveforms': waveforms,
+        'waveform_indices': _index_array(getattr(sorter, 'aligned_spike_indices', None)),
+        'waveform_scale': np.float64(scale),
+        'features': features,
+        'config': np.array(json.dumps(config)),
+        'metadata': np.array(json.dumps(metadata if metadata is not None else {})),
+    }
+
+
+def write_results(filename, results, compress=True):
+    """
+    Writes a results dictionary (see collect_results) to filename (.npz)
+    """
+    missing = [field for field in RESULT_FIELDS if field not in results]
+    if len(missing) > 0:
+        raise ValueError('Results are missing the fields {}'.format(missing))
+    with open(filename, 'wb') as fp:
+        if compress:
+            np.savez_compressed(fp, **{field: results[field] for field in RESULT_FIELDS})
+        else:
+            np.savez(fp, **{field: results[field] for field in RESULT_FIELDS})
+
+
+def save_results(sorter, filename, waveform_dtype='float32', metadata=None, compress=True):
+    """
+    Saves the results of a SimpleSpikeSorter to filename (.npz)
+    """
+    write_results(filename, collect_results(sorter, waveform_dtype, metadata), compress)
+
+
+def load_results(filename, fields=None, decode_waveforms=True):
+    """
+    Loads a results file written by save_results
+    fields: the fields to load (default all of RESULT_FIELDS). Only the requested
+    fields are read and decompressed.
+    decode_waveforms: convert stored int16/float16 waveforms back to float32 volts
+    Returns a dictionary, 'config' and 'metadata' are decoded to dictionaries.
+    """
+    if fields is None:
+        fields = RESULT_FIELDS
+    results = {}
+    with np.load(filename, allow_pickle=False) as archive:
+        for field in fields:
+            if field not in archive.files:
+                raise KeyError('{} is not a field of {}'.format(field, filename))
+            results[field] = archive[field]
+        if 'waveforms' in results and decode_waveforms:
+            scale = results['waveform_scale'] if 'waveform_scale' in results else archive['waveform_scale']
+            results['waveforms'] = _decode_waveforms(results['waveforms'], scale)
+    for field in ('config', 'metadata'):
+        if field in results:
+            results[field] = json.loads(str(results[field]))
+    for field in ('schema_version', 'signal_size'):
+        if field in results:
+            results[field] = int(results[field])
+    for field in ('dt', 'waveform_scale'):
+        if field in results:
+            results[field] = float(results[field])
+    return results
+
+
+def load_spike_times(filenames, kind='spikes', in_seconds=True):
+    """
+    Loads only the spike times from a list of results files
+    kind: 'spikes' for all detected spikes or 'cs' for complex spikes
+    in_seconds: return times in seconds, otherwise sample indices
+    Returns a list of arrays, in the order of filenames
+    """
+    if kind == 'spikes':
+        field = 'spike_indices'
+    elif kind == 'cs':
+        field = 'cs_indices'
+    else:
+        raise ValueError('Unknown spike kind {}'.format(kind))
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    spike_times = []
+    for filename in filenames:
+        with np.load(filename, allow_pickle=False) as archive:
+            indices = archive[field]
+            if in_seconds:
+                spike_times.append(indices * float(archive['dt']))
+            else:
+                spike_times.append(indices)
+    return spike_times
+
+
+def _index_array(indices):
+    if indices is None:
+        return np.zeros((0,), dtype='int64')
+    return np.atleast_1d(np.asarray(indices, dtype='int64'))
+
+
+def _encode_waveforms(waveforms, waveform_dtype):
+    """
+    Converts waveforms to their storage type, returns (waveforms, scale)
+    """
+    if waveform_dtype != 'int16':
+        return waveforms.astype(waveform_dtype), 1.0
+    if waveforms.size == 0:
+        return waveforms.astype('int16'), 1.0
+    peak = np.max(np.abs(waveforms))
+    if np.issubdtype(waveforms.dtype, np.integer) or \
+            (peak <= np.iinfo('int16').max and np.all(np.mod(waveforms, 1) == 0)):
+        return waveforms.astype('int16'), 1.0  # Already integral (raw ADC counts), lossless
+    scale = peak / np.iinfo('int16').max if peak > 0 else 1.0
+    return np.round(waveforms / scale).astype('int16'), scale
+
+
+def _decode_waveforms(waveforms, scale):
+    if waveforms.dtype == np.int16 or waveforms.dtype == np.float16:
+        return waveforms.astype('float32') * np.float32(scale)
+    return waveforms
@@ -10,6 +10,7 @@ import scipy.signal
 import scipy.fftpack
 from scipy.stats import norm
 import time
+from joblib import Parallel, delayed
 from matplotlib import pyplot as plt
 from kaveh.plots import axvlines
 
@@ -19,7 +20,9 @@ class SimpleSpikeSorter:
         """
         Object constructor
         """
-        self.voltage = np.squeeze(np.array(voltage))
+        # voltage may be a shared array (see kaveh.batch.shared), it is then passed to the detection processes as is
+        self.shared_voltage = voltage if hasattr(voltage, 'unlink') else None
+        self.voltage = np.squeeze(np.asarray(voltage.array if self.shared_voltage is not None else voltage))  # No copy
         self.signal_size = self.voltage.size
         self.dt = dt
         self.low_pass_filter_cutoff = 10000 #Hz
@@ -30,21 +33,31 @@ class SimpleSpikeSorter:
         self.pre_window = 0.0005 #s
         self.post_window = 0.005 #s
         self.minibatch_thresh = 50 #s - for spike detection: if signal length more than this, switch to minibatch GMM
+        self.n_jobs = 1 # number of processes for minibatch spike detection
+        self.shared_backend = 'memmap' # how the signals are shared with the detection processes ('memmap' or 'shm')
         # Complex spike detection parameters:
         self.freq_range = (0, 5000) #Hz
         self.cs_num_gmm_components = 2
         self.cs_cov_type = 'tied'
         self.post_cs_pause_time = 0.010 #s
+        self.cs_features = 'power' # clustering features: 'power' (max spectral power) or 'power+pca' (and waveform PCs)
+        self.captured_variance = 0.75 # fraction of the waveform variance captured by the PCA features
+        self.pca_sample_size = 10000 # number of waveforms the principal components are computed from
 
     def run(self):
-        #start = time.time()
+        start = time.time()
         self._pre_process()
-        print('Pre-process time = {}'.format(time.time() - start))
+        self.timings = {'pre_process': time.time() - start}
+        print('Pre-process time = {}'.format(self.timings['pre_process']))
         delta = int(self.minibatch_thresh / self.dt)
+        start = time.time()
         if delta >= self.signal_size:
             self._detect_spikes()
+        elif self.n_jobs > 1:
+            self._detect_spikes_minibatch_parallel()
         else:
             self._detect_spikes_minibatch()
+        self.timings['detect'] = time.time() - start
         #print('Spike detection time = {}'.format(time.time() - start))
         #self._align_spikes()
         #print('Align spikes time = {}'.format(time.time() - start))
@@ -96,24 +109,8 @@ class SimpleSpikeSorter:
         """
         Preliminary spike detection using a Gaussian Mixture Model, using only a range of signal
         """
-        voltage_signal = self.voltage_filtered[prange]
-        signal_unfiltered = self.voltage[prange]
-        gmm = GaussianMixture(self.num_gmm_components,
-                covariance_type = 'tied').fit(voltage_signal.reshape(-1,1))
-        cluster_labels = gmm.predict(voltage_signal.reshape(-1,1))
-        cluster_labels = cluster_labels.reshape(voltage_signal.shape)
-        spikes_cluster = np.argmax(gmm.means_)
-        all_spike_indices = np.squeeze(np.where(cluster_labels == spikes_cluster))
-        # Find peaks of each spike
-        peak_times,_ = scipy.signal.find_peaks(voltage_signal[all_spike_indices])
-        spike_indices = all_spike_indices[peak_times]
-        first_index = spike_indices[0]
-        spike_peaks = np.array([np.argmax(signal_unfiltered[max(0, si - int(0.0005/self.dt)) : si + int(0.002/self.dt)]) for si in spike_indices])
-        spike_indices = spike_indices + spike_peaks - int(0.0005/self.dt)
-        # in case the first window is less then the 0.0005/dt
-        if spike_indices[0] < 0:
-            spike_indices[0] = spike_peaks[0]
-        return spike_indices
+        return _detect_spikes_in_signal(self.voltage_filtered[prange], self.voltage[prange],
+                                        self.dt, self.num_gmm_components)
 
     def _detect_spikes_minibatch(self):
         """
@@ -127,8 +124,39 @@ class SimpleSpikeSorter:
             curr_indices = self._detect_spikes_from_range(slice(i, i + delta)) 
             curr_indices = curr_indices + i
             self.spike_indices = np.concatenate((self.spike_indices, curr_indices), axis=None)
-	
-    
+
+    def _detect_spikes_minibatch_parallel(self):
+        """
+        Same as _detect_spikes_minibatch, with the batches distributed over n_jobs processes.
+        The signals are shared with the processes instead of being pickled: the raw signal is used as
+        is when the sorter was built on a shared array (otherwise it is copied once) and the filtered
+        signal is moved to shared memory for the time of the detection. Every process returns the
+        spike indices of its batches.
+        """
+        print('Using parallel minibatch spike detection, batch size = {}s, {} processes'.format(
+            self.minibatch_thresh, self.n_jobs))
+        from kaveh.batch.shared import shared_copy, unshare  # Only the parallel detection needs shared memory
+        delta = int(self.minibatch_thresh/self.dt)
+        starts = np.arange(0, self.voltage_filtered.size - int(10/self.dt), delta)
+        if self.shared_voltage is not None and self.shared_voltage.array.shape == self.voltage.shape:
+            voltage = self.shared_voltage
+        else:
+            voltage = shared_copy(self.voltage, self.shared_backend)
+        voltage_filtered = shared_copy(self.voltage_filtered, self.shared_backend)
+        self.voltage_filtered = None  # Only the shared copy is kept during the detection
+        try:
+            jobs = np.array_split(starts, min(self.n_jobs, starts.size))
+            spikes = Parallel(n_jobs=self.n_jobs)(delayed(_detect_spikes_shared)(voltage, voltage_filtered,
+                    self.dt, self.num_gmm_components, batch_starts, delta)
+                for batch_starts in jobs)
+            self.spike_indices = np.concatenate([np.array([], dtype='int64')] +
+                                                [indices for job in spikes for indices in job])
+        finally:
+            self.voltage_filtered = unshare(voltage_filtered)
+            if voltage is not self.shared_voltage:
+                voltage.unlink()
+
+
     def _remove_overlapping_spike_windows(self):
         """
         Removes the spike indices that have overlapping alignment windows
@@ -162,24 +190,58 @@ class SimpleSpikeSorter:
         spike_indices = self._remove_overlapping_spike_windows()
 
         if use_filtered:
-            signal_size_f = self.voltage_filtered.size
-            self.aligned_spikes = np.array([self.voltage_filtered[i - pre_index : i + post_index ] 
-                for i in spike_indices if i not in to_exclude if (i + post_index) < signal_size_f
-                    if (i - pre_index) >= 0])
+            signal = self.voltage_filtered
         else:
-            signal_size = self.voltage.size
-            self.aligned_spikes = np.array([self.voltage[i - pre_index : i + post_index ] 
-                for i in spike_indices if i not in to_exclude if (i + post_index) < signal_size
-                    if (i - pre_index) >= 0])
+            signal = self.voltage
+        self.aligned_spike_indices = np.array([i for i in spike_indices if i not in to_exclude
+            if (i + post_index) < signal.size if (i - pre_index) >= 0], dtype='int64')
+        self.aligned_spikes = np.array([signal[i - pre_index : i + post_index ]
+            for i in self.aligned_spike_indices])
 
             
 
-    # TODO
-    def _choose_num_features(self, captured_variance=0.75):
+    def _choose_num_features(self, captured_variance=None):
         """
         Use the number of components that captures at least captured_variance of the spike waveforms
-        """
-        return 0
+        The principal components are computed on a random subsample of pca_sample_size aligned waveforms
+        (stored in pca_coeff, pca_mean and the component variances in pca_latent), the cost does
+        not grow with the number of spikes.
+        captured_variance: defaults to self.captured_variance
+        Returns the number of components
+        """
+        from toolbox.util import pca  # Not at module level, toolbox.util needs h5py
+        if captured_variance is None:
+            captured_variance = self.captured_variance
+        waveforms = self.aligned_spikes
+        if waveforms.shape[0] > self.pca_sample_size:
+            sample = np.sort(np.random.default_rng(0).choice(waveforms.shape[0], self.pca_sample_size, replace=False))
+            waveforms = waveforms[sample]
+        waveforms = np.asarray(waveforms, dtype='float32')
+        coeff, _, latent, percent_explained = pca(waveforms, method='eigh', dtype='float64')
+        num_features = min(int(np.searchsorted(np.cumsum(percent_explained), 100 * captured_variance)) + 1,
+                           coeff.shape[1])
+        self.pca_mean = np.mean(waveforms, axis=0, dtype='float64')
+        self.pca_coeff = coeff[:, :num_features]
+        self.pca_latent = latent[:num_features]
+        return num_features
+
+    def _find_pca_features(self, chunk_size=65536):
+        """
+        Projects all the aligned spike waveforms onto the principal components chosen by
+        _choose_num_features (in chunks of chunk_size waveforms)
+        The scores are whitened (unit variance per component) and scaled by 1/sqrt(components),
+        so that the whole block has unit variance whatever the number of components
+        Returns a (spikes x components) float32 array
+        """
+        num_features = self._choose_num_features()
+        scale = 1.0 / np.sqrt(np.maximum(self.pca_latent, np.finfo('float64').tiny) * num_features)
+        coeff = (self.pca_coeff * scale).astype('float32')
+        offset = np.dot(self.pca_mean, self.pca_coeff * scale).astype('float32')
+        features = np.empty((self.aligned_spikes.shape[0], num_features), dtype='float32')
+        for start in range(0, self.aligned_spikes.shape[0], chunk_size):
+            chunk = np.asarray(self.aligned_spikes[start:start + chunk_size], dtype='float32')
+            features[start:start + chunk_size] = np.dot(chunk, coeff) - offset
+        return features
     
     def _find_max_powers(self):
         """
@@ -191,7 +253,7 @@ class SimpleSpikeSorter:
         for wf in self.aligned_spikes:
             yf = scipy.fftpack.fft(wf)
             N = wf.size
-            xf = np.linspace(0.0, 1.0 / (2.0 * self.dt), N/2)
+            xf = np.linspace(0.0, 1.0 / (2.0 * self.dt), N//2)
             mask = (xf < self.freq_range[1]) & (xf >= self.freq_range[0])
             power_spectrum = 2.0/N * np.abs(yf[:N//2])
             max_powers = max_powers + [np.max(power_spectrum[mask])]
@@ -210,7 +272,7 @@ class SimpleSpikeSorter:
         for wf in self.aligned_spikes:
             yf = scipy.fftpack.fft(wf)
             N = wf.size
-            xf = np.linspace(0.0, 1.0 / (2.0 * self.dt), N/2)
+            xf = np.linspace(0.0, 1.0 / (2.0 * self.dt), N//2)
             mask = (xf < self.freq_range[1]) & (xf >= self.freq_range[0])
             power_spectrum = 2.0/N * np.abs(yf[:N//2])
             max_powers = max_powers + [np.sum(power_spectrum[mask])]
@@ -223,15 +285,26 @@ class SimpleSpikeSorter:
         """
         Clusters the found spikes into simple and complex, using a gmm_nc component GMM
         It uses the maximum power in the lower region of the frequency spectrum of the 
-        spike waveforms
+        spike waveforms (and with cs_features = 'power+pca' the principal components of the
+        waveforms, see _choose_num_features). The complex spikes are the cluster with the
+        largest mean power.
+        With 'power+pca', the power is standardized (zero mean, unit variance) and the PCA block
+        whitened to unit total variance (see _find_pca_features) before they are concatenated,
+        so that neither block dominates the (tied) GMM covariance because of its scale.
         """
         max_powers = self._find_max_powers()[0]
-        gmm = GaussianMixture(self.cs_num_gmm_components, covariance_type = self.cs_cov_type, random_state=0).fit(max_powers.reshape(-1,1))
-        cluster_labels = gmm.predict(max_powers.reshape(-1,1))
+        self.features = max_powers.reshape(-1, 1)
+        if self.cs_features == 'power+pca':
+            power = (max_powers - np.mean(max_powers)) / max(np.std(max_powers), np.finfo('float64').tiny)
+            self.features = np.hstack((power.reshape(-1, 1), self._find_pca_features()))
+        elif self.cs_features != 'power':
+            raise ValueError('Unknown complex spike features {}'.format(self.cs_features))
+        gmm = GaussianMixture(self.cs_num_gmm_components, covariance_type = self.cs_cov_type, random_state=0).fit(self.features)
+        cluster_labels = gmm.predict(self.features)
         cluster_labels = cluster_labels.reshape(max_powers.shape)
 
-        cs_indices = self.get_spike_indices()[cluster_labels == np.argmax(gmm.means_)]
-        if plot_hist:
+        cs_indices = self.get_spike_indices()[cluster_labels == np.argmax(gmm.means_[:, 0])]
+        if plot_hist and self.features.shape[1] == 1:
             plt.figure()
             # uniq = np.unique(ss.d_voltage[prang] , return_counts=True)
             x = np.arange(np.min(max_powers), np.max(max_powers), 1)
@@ -362,4 +435,34 @@ class SimpleSpikeSorter:
         
 
 
-
+def _detect_spikes_in_signal(voltage_filtered, voltage, dt, num_gmm_components):
+    """
+    Preliminary spike detection using a Gaussian Mixture Model on a (range of a) signal
+    Returns the spike indices relative to the start of the signals
+    """
+    gmm = GaussianMixture(num_gmm_components,
+            covariance_type = 'tied').fit(voltage_filtered.reshape(-1,1))
+    cluster_labels = gmm.predict(voltage_filtered.reshape(-1,1))
+    cluster_labels = cluster_labels.reshape(voltage_filtered.shape)
+    spikes_cluster = np.argmax(gmm.means_)
+    all_spike_indices = np.squeeze(np.where(cluster_labels == spikes_cluster))
+    # Find peaks of each spike
+    peak_times,_ = scipy.signal.find_peaks(voltage_filtered[all_spike_indices])
+    spike_indices = all_spike_indices[peak_times]
+    spike_peaks = np.array([np.argmax(voltage[max(0, si - int(0.0005/dt)) : si + int(0.002/dt)]) for si in spike_indices])
+    spike_indices = spike_indices + spike_peaks - int(0.0005/dt)
+    # in case the first window is less then the 0.0005/dt
+    if spike_indices[0] < 0:
+        spike_indices[0] = spike_peaks[0]
+    return spike_indices
+
+
+def _detect_spikes_shared(voltage, voltage_filtered, dt, num_gmm_components, starts, delta):
+    """
+    Runs minibatch spike detection on the batches of shared signals that begin at starts
+    (executed in a worker process)
+    Returns the spike indices of every batch
+    """
+    return [_detect_spikes_in_signal(voltage_filtered.array[start:start + delta], voltage.array[start:start + delta],
+                                     dt, num_gmm_components) + start
+            for start in starts]
@@ -14,12 +14,8 @@ do
 	echo -------------$2 Content \(tail\)--------;
 	tail $2 
 	printf "%*s\n" $(tput cols) '' | tr ' ' -
-	echo -------------Number of "readings"-------------------;
-	cat $1 | grep reading | wc -l;
+	echo -------------Batch progress---------------------;
+	python -m kaveh.batch.progress ${3:-../scratch/auto_processed_spike_sort/batch_status.json};
 	printf "%*s\n" $(tput cols) '' | tr ' ' -
-	echo -------------Number of "writings"-------------------; 
-	cat $1 | grep writing | wc -l; 
-	printf "%*s\n" $(tput cols) '' | tr ' ' -
-	find ../scratch/auto_processed -type f -name "*.pkl" | wc -l
 	sleep 100; 
 done
@@ -1,12 +1,8 @@
 from smr import File
 import numpy as np
 from kaveh.sorting.spikesorter import SimpleSpikeSorter
+from kaveh.sorting.results import save_results
 
-try:
-    import cPickle as pickle
-except ModuleNotFoundError:
-    import pickle
-    
 import fnmatch
 import os
 
@@ -40,10 +36,11 @@ for root, dirnames, filenames in os.walk(source_path):
             sss.cs_num_gmm_components = 4
             sss.run()
 
-            output_filename = os.path.join(path_to_mkdir, filename + '.pkl')
-            with open(output_filename, 'wb') as output:
-                print('writing {} ...'.format(output_filename))
-                pickle.dump(smr_content, output, pickle.HIGHEST_PROTOCOL)
+            output_filename = os.path.join(path_to_mkdir, filename + '.npz')
+            metadata = {'source': os.path.join(root, filename), 'channel': voltage_chan.channel_number,
+                        'channel_title': voltage_chan.title, 'header': smr_content.header()}
+            print('writing {} ...'.format(output_filename))
+            save_results(sss, output_filename, metadata=metadata)
 
 if found_source == 0:
     print('Path {} not found'.format(source_path))
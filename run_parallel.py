@@ -1,14 +1,13 @@
 from smr import File
 import numpy as np
 from kaveh.sorting.spikesorter import SimpleSpikeSorter
+from kaveh.sorting.results import save_results
+from kaveh.batch.cohort import build_cohort_index
+from kaveh.batch.progress import ProgressTracker, NullReporter
+from kaveh.batch.pipeline import run_pipeline
 from joblib import Parallel, delayed
 import multiprocessing
 
-try:
-    import cPickle as pickle
-except ModuleNotFoundError:
-    import pickle
-    
 import fnmatch
 import os
 from psutil import virtual_memory
@@ -30,34 +29,49 @@ def with_timeout(timeout):
     return decorator
 
 @with_timeout(9600)
-def processInputFile(arg):
+def processInputFile(arg, reporter=None):
     input_fn, output_fn = arg
-    print('reading {} ...'.format(input_fn))
-    smr_content = File(input_fn)
-    smr_content.read_channels()
-    voltage_chan = smr_content.get_channel(0)
-    if voltage_chan.data.size > 0 :
-	    print('processing {}...'.format(input_fn))
-	    sss = SimpleSpikeSorter(voltage_chan.data, voltage_chan.dt)
-	    sss.freq_range = (0, 5000)
-	    sss.cs_cov_type = 'tied'
-	    sss.cs_num_gmm_components = 4
-	    sss.run()
-	    sss.voltage = []
-	    sss.voltage_filtered = []
-	    with open(output_fn, 'wb') as output:
-		print('writing {} ...'.format(output_fn))
-		pickle.dump(sss, output, pickle.HIGHEST_PROTOCOL)
-    else:
-	print('No data in channel for {}'.format(input_fn))
-
-	
+    if reporter is None:
+        reporter = NullReporter()
+    reporter.started(input_fn, os.path.getsize(input_fn))
+    try:
+        print('reading {} ...'.format(input_fn))
+        with reporter.stage(input_fn, 'read'):
+            smr_content = File(input_fn)
+            smr_content.read_channels()
+            voltage_chan = smr_content.get_channel(0)
+        if voltage_chan.data.size > 0 :
+            print('processing {}...'.format(input_fn))
+            sss = SimpleSpikeSorter(voltage_chan.data, voltage_chan.dt)
+            for key in sorter_settings:
+                setattr(sss, key, sorter_settings[key])
+            sss.run()
+            for stage in sss.timings:
+                reporter.stage_time(input_fn, stage, sss.timings[stage])
+            metadata = {'source': input_fn, 'channel': voltage_chan.channel_number,
+                        'channel_title': voltage_chan.title, 'header': smr_content.header()}
+            print('writing {} ...'.format(output_fn))
+            with reporter.stage(input_fn, 'write'):
+                save_results(sss, output_fn, waveform_dtype='int16', metadata=metadata)
+        else:
+            print('No data in channel for {}'.format(input_fn))
+    except Exception as e:
+        reporter.failed(input_fn, e)
+        raise
+    reporter.finished(input_fn, voltage_chan.data.size)
+    return True
 
 
 source_path = '../scratch/raw_data/'
 #source_path = '/mnt/papers/Herzfeld_Nat_Neurosci_2018/raw_data/2006/Oscar/O89/'
 target_path = '../scratch/auto_processed_spike_sort/'
 #target_path = '/mnt/data/temp/kaveh/'
+status_file = os.path.join(target_path, 'batch_status.json')
+metrics_port = 8765  # Prometheus text on http://127.0.0.1:8765/metrics, None to disable
+pipeline_mode = True  # Overlap reading, sorting and writing (see kaveh.batch.pipeline)
+prefetch = 2  # Number of files read ahead of the workers in pipeline mode
+sort_timeout = 9600  # Maximum time (s) to sort one file in pipeline mode
+sorter_settings = {'freq_range': (0, 5000), 'cs_cov_type': 'tied', 'cs_num_gmm_components': 4}
 
 process_inputs = []
 
@@ -69,19 +83,35 @@ for root, dirnames, filenames in os.walk(source_path):
             if not os.path.exists(path_to_mkdir):
                 os.makedirs(path_to_mkdir)
             print('Found smr file: {}'.format(os.path.join(root, filename)))
-	    input_filename = os.path.join(root, filename)
-            output_filename = os.path.join(path_to_mkdir, filename + '.pkl')
-	    if not os.path.exists(output_filename):
-	   	 process_inputs = process_inputs + [(input_filename, output_filename)]
+            input_filename = os.path.join(root, filename)
+            output_filename = os.path.join(path_to_mkdir, filename + '.npz')
+            if not os.path.exists(output_filename):
+                process_inputs = process_inputs + [(input_filename, output_filename)]
 num_cores = multiprocessing.cpu_count()
 #num_cores = 6
 mem = virtual_memory()
 mem_total = mem.total/(1024*1024)
-num_cores = mem_total/48000
+num_cores = max(1, int(mem_total/48000))
 print('Using {} processes based on available memory: {}MB'.format(num_cores, mem_total))
 
 #print('Number of cores to be used = {}'.format(num_cores))     
-for i in np.arange(0, len(process_inputs), num_cores):
-	print('Running from {} to {} out of {} processes'.format(i, i+num_cores, len(process_inputs)))
-	Parallel(n_jobs = num_cores, verbose=1)(map(delayed(processInputFile), process_inputs[i:i+num_cores]))
-	
+with ProgressTracker(len(process_inputs), status_file=status_file, port=metrics_port) as tracker:
+    if pipeline_mode:
+        run_pipeline(process_inputs, num_cores, sorter_settings, prefetch=prefetch,
+                     reporter=tracker.reporter, timeout=sort_timeout)
+    else:
+        for i in np.arange(0, len(process_inputs), num_cores):
+            print('Running from {} to {} out of {} processes'.format(i, i+num_cores, len(process_inputs)))
+            chunk = process_inputs[i:i+num_cores]
+            done = Parallel(n_jobs = num_cores, verbose=1)(delayed(processInputFile)(arg, tracker.reporter)
+                                                            for arg in chunk)
+            for arg, result in zip(chunk, done):
+                if result is None:  # with_timeout gave up on this file
+                    tracker.reporter.failed(arg[0], 'timeout')
+
+result_files = []
+for root, dirnames, filenames in os.walk(target_path):
+    result_files = result_files + [os.path.join(root, filename) for filename in sorted(filenames)
+                                   if filename.endswith('.smr.npz')]
+print('Building cohort index from {} result files'.format(len(result_files)))
+build_cohort_index(result_files, os.path.join(target_path, 'cohort_index'))
@@ -94,14 +94,15 @@ class Channel:
             #raise RuntimeError('Unknown channel type')
 
     def _read_adc_channel(self, fd):
+        blocks = []
         for i in range(0, len(self.blocks)):
             fd.seek(self.blocks[i] + 18)  # offset in block header (4 bytes x 4 ints (last, next, start, end) = 16) + short channel number
             num_elements = unpack_from_fd(fd, 'h')
-	    if num_elements == 1:
-            	self.data += [unpack_from_fd(fd, '{:d}h'.format(num_elements))]
-	    else:
-                self.data += list(unpack_from_fd(fd, '{:d}h'.format(num_elements)))
-        self.data = np.array(self.data, dtype='int16')
+            blocks.append(np.frombuffer(fd.read(2 * num_elements), dtype='int16'))
+        if len(blocks) > 0:
+            self.data = np.concatenate(blocks)
+        else:
+            self.data = np.array([], dtype='int16')
 
     def _read_event_channel(self, fd):
         for i in range(0, len(self.blocks)):
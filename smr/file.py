@@ -74,6 +74,22 @@ class File():
         channel = self._read_channel(index)
         return channel
 
+    def close(self):
+        """Closes the underlying file (channels that were read stay available)"""
+        self.fd.close()
+
+    def header(self):
+        """Returns the file header as a (JSON-serializable) dictionary"""
+        return {'filename': self.filename,
+                'system_id': self.system_id,
+                'creator': self.creator,
+                'us_per_time': self.us_per_time,
+                'time_per_adc': self.time_per_adc,
+                'num_channels': self.num_channels,
+                'time_base': self.time_base,
+                'time_date': dict(self.time_date),
+                'comment': self.comment}
+
     def __str__(self):
         x = ('SMR file: {:s}\n'.format(self.filename))
         x += ('System ID: {:d}\n'.format(self.system_id))
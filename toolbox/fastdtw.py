@@ -2,69 +2,485 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import, division, print_function, unicode_literals
-from collections import defaultdict
 
+import bisect
+import numpy as np
 from six.moves import xrange
 
+# Distances for which lower_bound is valid
+_BOUNDED_DISTANCES = ('euclidean', 'manhattan', 'abs', 'squared')
 
-def fastdtw(x, y, radius=1, dist=lambda a, b: abs(a - b)):
+
+def fastdtw(x, y, radius=1, dist=None):
+    """Approximate dynamic time warping in linear time and memory (FastDTW)
+
+    :param x: First sequence, either [N] samples or [N, d] vector samples (e.g. 2-D positions)
+    :param y: Second sequence, with the same sample dimension as x
+    :param radius: Size of the neighborhood searched around the projected coarse path
+    :param dist: Local distance between samples, either 'euclidean' (default), 'manhattan',
+    'squared' (squared euclidean) or a callable dist(a, b). For 1-D sequences 'euclidean' and
+    'manhattan' are both the absolute difference ('abs').
+    :return: (distance, path) where path is a list of (i, j) index pairs
+    """
+    x, y = _as_sequences(x, y)
+    distance, path = _fastdtw(x, y, radius, _cost_function(dist))
+    return (distance, [tuple(p) for p in path.tolist()])
+
+
+def _fastdtw(x, y, radius, cost, path=True):
+    """FastDTW recursion on arrays, returns (distance, path as an [n, 2] array)"""
     min_time_size = radius + 2
 
     if len(x) < min_time_size or len(y) < min_time_size:
-        return dtw(x, y, dist=dist)
+        return _dtw_band(x, y, np.zeros(len(x), dtype=np.int64), np.full(len(x), len(y), dtype=np.int64),
+                         cost, path)
 
     x_shrinked = __reduce_by_half(x)
     y_shrinked = __reduce_by_half(y)
-    distance, path = fastdtw(x_shrinked, y_shrinked, radius=radius, dist=dist)
-    window = __expand_window(path, len(x), len(y), radius)
-    return dtw(x, y, window, dist=dist)
+    distance, coarse_path = _fastdtw(x_shrinked, y_shrinked, radius, cost)
+    starts, ends = __expand_window(coarse_path, len(x), len(y), radius)
+    return _dtw_band(x, y, starts, ends, cost, path)
+
+
+def pairwise_dtw(X, Y=None, radius=1, dist=None, window=None, max_dist=None, n_jobs=1):
+    """DTW distance matrix between two collections of sequences
+
+    :param X: Sequences, a list of [N] or [N, d] arrays, or an array with one sequence per row
+    :param Y: Second collection (default None: distances within X, computed once per pair
+    thanks to symmetry)
+    :param radius: FastDTW radius (used when window is None)
+    :param dist: Local distance between samples, either 'euclidean' (default), 'manhattan',
+    'squared' (squared euclidean) or a callable dist(a, b). For 1-D sequences 'euclidean' and
+    'manhattan' are both the absolute difference ('abs').
+    :param window: If not None, compute the exact DTW restricted to a Sakoe-Chiba band of
+    this radius instead of FastDTW
+    :param max_dist: If not None, pairs whose distance exceeds max_dist are reported as inf.
+    Pairs whose lower bound (LB_Kim, LB_Keogh) already exceeds max_dist are skipped.
+    :param n_jobs: Number of processes (joblib)
+    :return: Distance matrix of shape [len(X), len(Y)]
+    """
+    from joblib import Parallel, delayed
+
+    X = [np.asarray(x, dtype=float) for x in X]
+    symmetric = Y is None
+    Y = X if symmetric else [np.asarray(y, dtype=float) for y in Y]
+    for x in X + Y:
+        _as_sequences(x, (X + Y)[0])  # Same sample dimension for all sequences
+    if symmetric:
+        rows, columns = np.triu_indices(len(X), k=1)
+    else:
+        rows, columns = np.indices((len(X), len(Y))).reshape(2, -1)
+
+    blocks = np.array_split(np.arange(len(rows)), max(1, min(len(rows), 4 * n_jobs)))
+    distances = Parallel(n_jobs=n_jobs)(
+        delayed(_pairwise_block)([X[i] for i in rows[block]], [Y[j] for j in columns[block]],
+                                 radius, dist, window, max_dist)
+        for block in blocks)
+    D = np.zeros((len(X), len(Y)))
+    D[rows, columns] = np.concatenate([np.zeros(0)] + distances)
+    if symmetric:
+        D[columns, rows] = D[rows, columns]
+    return D
+
+
+def _pairwise_block(xs, ys, radius, dist, window, max_dist):
+    """Distances between the sequence pairs (xs[n], ys[n])"""
+    cost = _cost_function(dist)
+    distances = np.full(len(xs), np.inf)
+    remaining = np.arange(len(xs))
+    if max_dist is not None and (dist is None or dist in _BOUNDED_DISTANCES):
+        bounds = np.array([_lower_bound(xs[n], ys[n], window, cost) for n in remaining])
+        remaining = remaining[bounds <= max_dist]
+    if window is None:
+        for n in remaining:
+            distances[n] = _fastdtw(xs[n], ys[n], radius, cost, path=False)[0]
+    else:
+        # Pairs of the same lengths share the same band and are evaluated together
+        shapes = {}
+        for n in remaining:
+            shapes.setdefault((len(xs[n]), len(ys[n])), []).append(n)
+        for (len_x, len_y), group in shapes.items():
+            if len_x == 0 or len_y == 0:
+                continue
+            starts, ends = sakoe_chiba_window(len_x, len_y, window)
+            distances[group] = _band_cost(np.stack([xs[n] for n in group]), np.stack([ys[n] for n in group]),
+                                          starts, ends, cost)[0]
+    if max_dist is not None:
+        distances[distances > max_dist] = np.inf
+    return distances
+
+
+def lower_bound(x, y, window=None, dist=None):
+    """Lower bound of the DTW distance (max of LB_Kim and LB_Keogh in both directions)
+
+    Valid for the built-in distances (not for callables), for the DTW restricted to a Sakoe-Chiba band
+    of radius window, or for the unrestricted DTW (and FastDTW) when window is None.
+    """
+    x, y = _as_sequences(x, y)
+    return _lower_bound(x, y, window, _cost_function(dist))
+
+
+def _lower_bound(x, y, window, cost):
+    # LB_Kim: every path contains the first and the last cell
+    lb_kim = cost(x[:1], y[:1])[0]
+    if len(x) > 1 or len(y) > 1:
+        lb_kim += cost(x[-1:], y[-1:])[0]
+    if window is None:
+        return max(lb_kim, _lb_keogh(x, y, None, None, cost), _lb_keogh(y, x, None, None, cost))
+    starts, ends = sakoe_chiba_window(len(x), len(y), window)
+    # The same band seen from y: column j is used by the rows [starts_y[j], ends_y[j])
+    columns = np.arange(len(y))
+    starts_y = np.searchsorted(ends, columns, side='right')
+    ends_y = np.searchsorted(starts, columns, side='right')
+    return max(lb_kim, _lb_keogh(x, y, starts, ends, cost), _lb_keogh(y, x, starts_y, ends_y, cost))
+
+
+def _lb_keogh(x, y, starts, ends, cost):
+    """LB_Keogh: every sample x[i] is matched to at least one sample of y[starts[i]:ends[i]]
+    (starts is None: to at least one sample of y). Vector samples use a per-dimension envelope.
+    """
+    if starts is None:
+        lower, upper = np.min(y, axis=0), np.max(y, axis=0)
+    else:
+        lower, upper = _envelope(y, starts, ends)
+    return float(np.sum(cost(x, np.clip(x, lower, upper))))
+
+
+def _envelope(y, starts, ends, axis=0):
+    """Minimum and maximum of y[starts[i]:ends[i]] along axis, for every i"""
+    bounds = np.stack((starts, ends), axis=1).ravel()
+    shape = list(y.shape)
+    shape[axis] = 1
+    padding = np.ones(shape)
+    # reduceat over [starts[i], ends[i]) (odd entries are the gaps between rows and are dropped)
+    rows = np.arange(0, len(bounds), 2)
+    upper = np.maximum.reduceat(np.concatenate((y, -np.inf * padding), axis=axis), bounds, axis=axis)
+    lower = np.minimum.reduceat(np.concatenate((y, np.inf * padding), axis=axis), bounds, axis=axis)
+    return np.take(lower, rows, axis=axis), np.take(upper, rows, axis=axis)
+
+
+def search_dtw(signal, template, window=None, k=1, max_dist=None, dist=None, exclusion=None,
+               chunk_size=65536):
+    """Finds the occurrences of a template in a long signal (subsequence DTW search)
+
+    Every segment signal[o:o + len(template)] is compared to the template with the DTW
+    restricted to a Sakoe-Chiba band. The signal is processed chunk_size offsets at a
+    time (memory-mapped signals are never loaded entirely), and candidate offsets go
+    through a cascade of lower bounds before the exact DTW is computed:
+    LB_Kim (first and last samples), LB_Keogh of the segment against the template
+    envelope, then LB_Keogh of the template against the segment envelope. Candidates
+    whose bound exceeds the current threshold are discarded. The remaining ones are
+    evaluated in batches, best bounds first, so that good matches tighten the threshold early.
+
+    :param signal: Signal, [L] samples or [L, d] vector samples (any array type that can be sliced,
+    e.g. an int16 memmap, it is only converted to float one chunk at a time)
+    :param template: Template, [m] or [m, d] samples
+    :param window: Radius of the Sakoe-Chiba band (default: 10% of the template length)
+    :param k: Number of matches to return (None: all matches within max_dist)
+    :param max_dist: If not None, only matches within this distance are returned
+    :param dist: Local distance between samples, either 'euclidean' (default), 'manhattan',
+    'squared' or a callable dist(a, b) (callables disable the lower bounds)
+    :param exclusion: Matches closer than exclusion samples to a better match are dropped
+    (default: half the template length), so every occurrence is reported once
+    :param chunk_size: Number of offsets processed at a time
+    :return: (offsets, distances) of the matches, best match first
+    """
+    if not hasattr(signal, 'shape'):
+        signal = np.asarray(signal)
+    # Not converted here (a memmap would be read entirely), chunks are cast to float below
+    template = np.asarray(template, dtype=float)
+    _check_sequences(signal, template)
+    if k is None and max_dist is None:
+        raise ValueError('Either k or max_dist must be given')
+    m = len(template)
+    n_offsets = len(signal) - m + 1
+    if window is None:
+        window = max(1, m // 10)
+    if exclusion is None:
+        exclusion = m // 2
+    cost = _cost_function(dist)
+    bounded = dist is None or dist in _BOUNDED_DISTANCES
+    starts, ends = sakoe_chiba_window(m, m, window)
+    lower, upper = _envelope(template, starts, ends)
+    # The band seen from the template: template sample j is matched to the segment samples [starts_y[j], ends_y[j])
+    starts_y = np.searchsorted(ends, np.arange(m), side='right')
+    ends_y = np.searchsorted(starts, np.arange(m), side='right')
+
+    def segment_cost(a, b):
+        """Sum of the local costs of batches of aligned samples, a and b are [n, m(, d)]"""
+        c = cost(a.reshape((-1,) + a.shape[2:]), np.broadcast_to(b, a.shape).reshape((-1,) + a.shape[2:]))
+        return np.sum(np.reshape(c, a.shape[:2]), axis=1)
+
+    # A greedy selection of the k best non overlapping matches contains a match at least as
+    # good as the (3k - 2)-th best of the per-block minima (blocks of exclusion offsets),
+    # because a selected match excludes offsets of at most 3 blocks. This gives the pruning threshold.
+    block_size = max(exclusion, 1)
+    rank = k if k is None or exclusion <= 1 else 3 * k - 2
+    block_best = {}
+    matches_offsets, matches_distances = [], []
+
+    def threshold():
+        tau = np.inf if max_dist is None else max_dist
+        if rank is not None and len(block_best) >= rank:
+            tau = min(tau, np.partition(np.fromiter(block_best.values(), dtype=float), rank - 1)[rank - 1])
+        return tau
 
+    for chunk_start in xrange(0, max(n_offsets, 0), chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, n_offsets)
+        segments = np.lib.stride_tricks.sliding_window_view(
+            np.asarray(signal[chunk_start:chunk_stop + m - 1], dtype=float), m, axis=0)
+        if segments.ndim == 3:  # sliding_window_view puts the window axis last
+            segments = np.swapaxes(segments, 1, 2)
+        offsets = np.arange(chunk_start, chunk_stop)
+        if bounded:
+            tau = threshold()
+            lb = cost(segments[:, 0], template[0]) + (cost(segments[:, -1], template[-1]) if m > 1 else 0)
+            keep = lb <= tau
+            offsets, lb = offsets[keep], lb[keep]
+            candidates = segments[keep]
+            lb = np.maximum(lb, segment_cost(candidates, np.clip(candidates, lower, upper)))
+            order = np.argsort(lb, kind='stable')
+            offsets, lb, candidates = offsets[order], lb[order], candidates[order]
+        else:
+            lb = np.zeros(len(offsets))
+            candidates = segments
+        for batch in xrange(0, len(offsets), 256):
+            tau = threshold()
+            keep = np.flatnonzero(lb[batch:batch + 256] <= tau) + batch
+            if len(keep) == 0:
+                break  # Bounds are sorted, no later candidate can be within the threshold
+            batch_offsets, batch_segments = offsets[keep], candidates[keep]
+            if bounded:
+                segment_lower, segment_upper = _envelope(batch_segments, starts_y, ends_y, axis=1)
+                keep = segment_cost(np.broadcast_to(template, batch_segments.shape),
+                                    np.clip(template, segment_lower, segment_upper)) <= tau
+                batch_offsets, batch_segments = batch_offsets[keep], batch_segments[keep]
+                if len(batch_offsets) == 0:
+                    continue
+            distances = _band_cost(batch_segments, np.broadcast_to(template, batch_segments.shape),
+                                   starts, ends, cost)[0]
+            keep = distances <= tau
+            matches_offsets.append(batch_offsets[keep])
+            matches_distances.append(distances[keep])
+            for offset, distance in zip(batch_offsets[keep] // block_size, distances[keep]):
+                block_best[offset] = min(block_best.get(offset, np.inf), distance)
 
-def dtw(x, y, window=None, dist=lambda a, b: abs(a - b)):
+    # Greedy selection of the best non overlapping matches
+    offsets = np.concatenate([np.zeros(0, dtype=np.int64)] + matches_offsets)
+    distances = np.concatenate([np.zeros(0)] + matches_distances)
+    tau = threshold()
+    selected, taken = [], []  # taken: sorted offsets of the selected matches
+    for n in np.lexsort((offsets, distances)):
+        if distances[n] > tau or (k is not None and len(selected) == k):
+            break
+        position = bisect.bisect(taken, offsets[n])
+        if (position > 0 and offsets[n] - taken[position - 1] < exclusion) or \
+                (position < len(taken) and taken[position] - offsets[n] < exclusion):
+            continue
+        taken.insert(position, offsets[n])
+        selected.append(n)
+    selected = np.array(selected, dtype=np.int64)
+    return offsets[selected], distances[selected]
+
+
+def dtw(x, y, window=None, dist=None):
+    """Dynamic time warping between two sequences
+
+    :param x: First sequence, either [N] samples or [N, d] vector samples (e.g. 2-D positions)
+    :param y: Second sequence, with the same sample dimension as x
+    :param window: Optional restriction of the warping path, either a list of (i, j) cells
+    or a tuple (starts, ends) of arrays such that row i may use the columns [starts[i], ends[i]).
+    The allowed columns of each row must be contiguous and move forward from row to row
+    (as for Sakoe-Chiba bands and FastDTW windows).
+    :param dist: Local distance between samples, either 'euclidean' (default), 'manhattan',
+    'squared' (squared euclidean) or a callable dist(a, b). For 1-D sequences 'euclidean' and
+    'manhattan' are both the absolute difference ('abs').
+    :return: (distance, path) where path is a list of (i, j) index pairs
+    """
+    x, y = _as_sequences(x, y)
     len_x, len_y = len(x), len(y)
     if window is None:
-        window = [(i, j) for i in xrange(len_x) for j in xrange(len_y)]
-    window = ((i + 1, j + 1) for i, j in window)
-    D = defaultdict(lambda: (float('inf'),))
-    D[0, 0] = (0, 0, 0)
-    for i, j in window:
-        dt = dist(x[i-1], y[j-1])
-        D[i, j] = min((D[i-1, j][0]+dt, i-1, j), (D[i, j-1][0]+dt, i, j-1), (D[i-1, j-1][0]+dt, i-1, j-1), key=lambda a: a[0])
-    path = []
-    i, j = len_x, len_y
+        starts, ends = np.zeros(len_x, dtype=np.int64), np.full(len_x, len_y, dtype=np.int64)
+    elif isinstance(window, tuple) and len(window) == 2 and isinstance(window[0], np.ndarray):
+        starts, ends = np.asarray(window[0], dtype=np.int64), np.asarray(window[1], dtype=np.int64)
+    else:
+        starts, ends = _window_to_band(window, len_x, len_y)
+    distance, path = _dtw_band(x, y, starts, ends, _cost_function(dist))
+    return (distance, [tuple(p) for p in path.tolist()])
+
+
+def sakoe_chiba_window(len_x, len_y, radius):
+    """Returns the (starts, ends) band of all cells within radius of the (scaled) diagonal"""
+    center = np.round(np.arange(len_x) * (len_y - 1) / max(len_x - 1, 1)).astype(np.int64)
+    starts = np.clip(center - radius, 0, len_y)
+    ends = np.clip(center + radius + 1, 0, len_y)
+    # Stretch rows up to the start of the next row, so that the band stays connected when len_y > len_x
+    ends[:-1] = np.maximum(ends[:-1], starts[1:])
+    return starts, ends
+
+
+def _window_to_band(window, len_x, len_y):
+    """Converts a list of (i, j) cells into per-row [start, end) intervals"""
+    window = np.unique(np.asarray(list(window), dtype=np.int64).reshape(-1, 2), axis=0)
+    window = window[(window[:, 0] >= 0) & (window[:, 0] < len_x) & (window[:, 1] >= 0) & (window[:, 1] < len_y)]
+    starts = np.full(len_x, len_y, dtype=np.int64)
+    ends = np.zeros(len_x, dtype=np.int64)
+    np.minimum.at(starts, window[:, 0], window[:, 1])
+    np.maximum.at(ends, window[:, 0], window[:, 1] + 1)
+    if np.any(ends <= starts):
+        raise ValueError('Window must contain at least one cell of every row')
+    if np.sum(ends - starts) != len(window) or np.any(np.diff(starts) < 0) or np.any(np.diff(ends) < 0):
+        raise ValueError('Window rows must be contiguous and move forward from row to row')
+    return starts, ends
+
+
+def _dtw_band(x, y, starts, ends, cost, path=True):
+    """Dynamic time warping restricted to a band of per-row column intervals [starts[i], ends[i])
+
+    :return: (distance, path as an [n, 2] array, or None if path is False)
+    """
+    len_x, len_y = len(x), len(y)
+    if len_x == 0 or len_y == 0 or not (starts[-1] <= len_y - 1 < ends[-1]):
+        return (np.inf, np.zeros((0, 2), dtype=np.int64))
+    distances, D, offsets = _band_cost(x[np.newaxis], y[np.newaxis], starts, ends, cost)
+    distance = float(distances[0])
+    if not path:
+        return (distance, None)
+    if np.isinf(distance):  # The end cannot be reached within the window
+        return (distance, np.zeros((0, 2), dtype=np.int64))
+    return (distance, _traceback(D[0], starts, ends, offsets, len_x, len_y))
+
+
+def _band_cost(xs, ys, starts, ends, cost):
+    """Cumulative DTW cost of a batch of sequence pairs (xs[b], ys[b]) sharing the same band
+
+    The cumulative cost of the band cells is kept in one flat array per pair (row i occupies
+    offsets[i]:offsets[i] + ends[i] - starts[i]), so memory is proportional to the band
+    size. The band is filled one anti-diagonal at a time: every cell of an anti-diagonal
+    only depends on the two previous anti-diagonals, so each one is evaluated with a
+    single vectorized numpy operation over all its cells and all pairs of the batch.
+
+    The last cell (len_x - 1, len_y - 1) must belong to the band.
+
+    :return: (distances of the pairs, cumulative costs [batch, band size], row offsets)
+    """
+    batch, len_x, len_y = xs.shape[0], xs.shape[1], ys.shape[1]
+    widths = ends - starts
+    offsets = np.concatenate(([0], np.cumsum(widths)[:-1])).astype(np.int64)
+    D = np.full((batch, int(np.sum(widths))), np.inf)
+    # Band of the previous row (row -1 is empty)
+    prev_starts = np.concatenate(([0], starts[:-1]))
+    prev_ends = np.concatenate(([0], ends[:-1]))
+    prev_offsets = np.concatenate(([0], offsets[:-1]))
+
+    # Rows crossing anti-diagonal k are lo[k] <= i < hi[k], because i + starts[i] and
+    # i + ends[i] are increasing in i
+    k = np.arange(len_x + len_y - 1)
+    lo = np.searchsorted(np.arange(len_x) + ends, k, side='right')
+    hi = np.searchsorted(np.arange(len_x) + starts, k, side='right')
+    for k in xrange(len_x + len_y - 1):
+        if lo[k] >= hi[k]:
+            continue
+        i = np.arange(lo[k], hi[k])
+        j = k - i
+        index = offsets[i] + j - starts[i]
+        # Local costs of all the cells of the anti-diagonal, for all the pairs at once
+        c = cost(xs[:, i].reshape((-1,) + xs.shape[2:]), ys[:, j].reshape((-1,) + ys.shape[2:]))
+        c = np.reshape(c, (batch, len(i)))
+        if k == 0:  # The path starts at (0, 0)
+            D[:, index] = c
+            continue
+        left = np.where(j - 1 >= starts[i], D[:, np.maximum(index - 1, 0)], np.inf)
+        inside = (prev_starts[i] <= j) & (j < prev_ends[i])
+        up = np.where(inside, D[:, np.where(inside, prev_offsets[i] + j - prev_starts[i], 0)], np.inf)
+        inside = (prev_starts[i] <= j - 1) & (j - 1 < prev_ends[i])
+        diagonal = np.where(inside, D[:, np.where(inside, prev_offsets[i] + j - 1 - prev_starts[i], 0)], np.inf)
+        D[:, index] = c + np.minimum(np.minimum(up, left), diagonal)
+
+    return (D[:, offsets[-1] + len_y - 1 - starts[-1]], D, offsets)
+
+
+def _traceback(D, starts, ends, offsets, len_x, len_y):
+    """Recovers the warping path from the cumulative cost of a band"""
+    def value(i, j):
+        if i < 0 or j < starts[i] or j >= ends[i]:
+            return np.inf
+        return D[offsets[i] + j - starts[i]]
+
+    i, j = len_x - 1, len_y - 1
+    path = [(i, j)]
     while not (i == j == 0):
-        path.append((i-1, j-1))
-        i, j = D[i, j][1], D[i, j][2]
+        # Ties are resolved in the order (i - 1, j), (i, j - 1), (i - 1, j - 1)
+        candidates = ((i - 1, j), (i, j - 1), (i - 1, j - 1))
+        i, j = min(candidates, key=lambda a: value(*a))
+        path.append((i, j))
     path.reverse()
-    return (D[len_x, len_y][0], path)
+    return np.array(path, dtype=np.int64)
+
+
+def _cost_function(dist):
+    """Returns a vectorized local cost function c(a, b) for arrays of samples a and b
+
+    Samples are scalars ([n] arrays) or vectors ([n, d] arrays), c returns one cost per sample.
+    """
+    if dist is None or dist == 'euclidean':
+        return lambda a, b: np.abs(a - b) if a.ndim == 1 else np.sqrt(np.sum((a - b) ** 2, axis=1))
+    elif dist == 'manhattan' or dist == 'abs':
+        return lambda a, b: np.abs(a - b) if a.ndim == 1 else np.sum(np.abs(a - b), axis=1)
+    elif dist == 'squared':
+        return lambda a, b: (a - b) ** 2 if a.ndim == 1 else np.sum((a - b) ** 2, axis=1)
+    elif callable(dist):
+        def cost(a, b):
+            # Try the callable on whole arrays first, fall back to calling it per sample pair
+            try:
+                c = np.asarray(dist(a, b), dtype=float)
+                if c.shape == (len(a),):
+                    return c
+            except Exception:
+                pass
+            return np.array([dist(a[n], b[n]) for n in xrange(len(a))], dtype=float)
+        return cost
+    raise ValueError('Unknown distance {}'.format(dist))
+
+
+def _as_sequences(x, y):
+    """Converts x and y to float arrays of [N] scalar or [N, d] vector samples"""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    _check_sequences(x, y)
+    return x, y
+
+
+def _check_sequences(x, y):
+    """Checks that x and y are [N] or [N, d] arrays with the same sample dimension"""
+    if x.ndim not in (1, 2) or y.ndim not in (1, 2):
+        raise ValueError('Sequences must be [N] or [N, d] arrays')
+    if x.shape[1:] != y.shape[1:]:
+        raise ValueError('Sequences have different sample dimensions {} and {}'.format(x.shape[1:], y.shape[1:]))
 
 
 def __reduce_by_half(x):
-    return [(x[i//2] + x[1+i//2]) / 2 for i in xrange(0, len(x), 2)]
+    """Averages consecutive pairs of (scalar or vector) samples (an odd last sample is kept as is)"""
+    if len(x) % 2 == 1:
+        x = np.concatenate((x, x[-1:]))
+    return (x[0::2] + x[1::2]) / 2
 
 
 def __expand_window(path, len_x, len_y, radius):
-    path_ = set(path)
-    for i, j in path:
-        for a, b in ((i + a, j + b) for a in xrange(-radius, radius+1) for b in xrange(-radius, radius+1)):
-            path_.add((a, b))
-
-    window_ = set()
-    for i, j in path_:
-        for a, b in ((i * 2, j * 2), (i * 2, j * 2 + 1), (i * 2 + 1, j * 2), (i * 2 + 1, j * 2 + 1)):
-            window_.add((a, b))
-
-    window = []
-    start_j = 0
-    for i in xrange(0, len_x):
-        new_start_j = None
-        for j in xrange(start_j, len_y):
-            if (i, j) in window_:
-                window.append((i, j))
-                if new_start_j is None:
-                    new_start_j = j
-            elif new_start_j is not None:
-                break
-        start_j = new_start_j
-
-    return window
+    """Projects a coarse path onto the finer resolution
+
+    The coarse path is widened by radius cells in every direction and every coarse cell
+    is then upsampled to its 2x2 block of fine cells. Returns the window as per-row
+    column intervals (starts, ends) of the fine resolution.
+    """
+    path = np.asarray(path, dtype=np.int64)
+    rows = np.arange((len_x + 1) // 2)
+    # Columns of the (monotone) coarse path in each coarse row
+    first = path[np.searchsorted(path[:, 0], rows, side='left'), 1]
+    last = path[np.searchsorted(path[:, 0], rows, side='right') - 1, 1]
+    # Widen by radius: rows r - radius..r + radius contribute, columns extend by radius
+    lo = first[np.maximum(rows - radius, 0)] - radius
+    hi = last[np.minimum(rows + radius, len(rows) - 1)] + radius
+    # Upsample: coarse row r covers the fine rows 2r and 2r + 1
+    starts = np.clip(np.repeat(2 * lo, 2)[:len_x], 0, len_y)
+    ends = np.clip(np.repeat(2 * hi + 2, 2)[:len_x], 0, len_y)
+    return starts, ends
@@ -4,83 +4,171 @@ Copyright (c) 2016 David Herzfeld
 Written by David J. Herzfeld <herzfeldd@gmail.com>
 """
 
-import struct 
 import os
+import struct
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
-def load(filename):
-    """Load an FHD binary file"""
+# Headers of linked lists (followed by num_contents child locations) and elements
+_LINKED_LIST_DTYPE = np.dtype([('next', 'u8'), ('previous', 'u8'), ('max_entries', 'u8'), ('num_contents', 'u8')])
+_ELEMENT_DTYPE = np.dtype([('location', 'u8'), ('element_type', 'u1'), ('name_length', 'u2')])
+
+def load(filename, lazy=False, threads=1):
+    """Load an FHD binary file
+
+    If lazy is True, only the structure of the file is read: datasets are returned as
+    LazyDataset objects that read (memory-map) their data when they are indexed.
+    If threads > 1, the groups referenced by pointer datasets (e.g. trials) are read
+    concurrently by a pool of threads using positional reads.
+    """
     if not os.path.isfile(filename):
         raise RuntimeError('File {:s} does not exist'.format(filename))
     # Open the file
-    fp = open(filename, 'rb')
-    
-    header = _read_header(fp)
-    root = _read_group(fp)
-    fp.close()
+    with open(filename, 'rb') as fp:
+        header = _read_header(fp)
+        name, root = _read_group(fp, lazy, threads)
+    if name != '/':
+        root = {name: root}
 
     return root
 
 def _read_header(fp):
     read_bytes = fp.read(1024)
-    magic_header = struct.unpack('@3s', read_bytes[0:3])[0].decode('utf-8')
-    if magic_header != 'fhd':
+    if read_bytes[0:3] != b'fhd':
         raise RuntimeError('FHD header is invalid')
-    header = {};
-    header['major_version'] = struct.unpack('@B', bytes([read_bytes[4]]))[0]
-    header['minor_version'] = struct.unpack('@B', bytes([read_bytes[5]]))[0]
-    header['minor_minor_version'] = struct.unpack('@B', bytes([read_bytes[6]]))[0]
-    header['pointer_size'] = struct.unpack('@B', bytes([read_bytes[7]]))[0]
-    header['num_pointer_entries'] = struct.unpack('@B', bytes([read_bytes[8]]))[0]
+    versions = np.frombuffer(read_bytes, dtype=np.uint8, count=5, offset=4)
+    header = {}
+    header['major_version'] = int(versions[0])
+    header['minor_version'] = int(versions[1])
+    header['minor_minor_version'] = int(versions[2])
+    header['pointer_size'] = int(versions[3])
+    header['num_pointer_entries'] = int(versions[4])
     return header
 
-def _read_group(fp, data={}):
+class _PositionalFile():
+    """Read-only file object over a shared descriptor that only uses positional reads
+    (os.pread), so that several threads can read the same file at the same time"""
+    def __init__(self, fd, name):
+        self.fd = fd
+        self.name = name
+        self.position = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self.fd).st_size
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size):
+        data = os.pread(self.fd, size, self.position)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        total = 0
+        while total < len(view): # Large reads may be split
+            data = os.pread(self.fd, len(view) - total, self.position + total)
+            if len(data) == 0:
+                break
+            view[total:total + len(data)] = data
+            total += len(data)
+        self.position += total
+        return total
+
+def _read_into(fp, out):
+    """Reads the bytes of the contiguous array out from the current position"""
+    if fp.readinto(out.reshape(-1).view(np.uint8)) != out.nbytes:
+        raise RuntimeError('Unexpected end of FHD file')
+    return out
+
+def _read_array(fp, dtype, count):
+    return _read_into(fp, np.empty(count, dtype=dtype))
+
+def _read_element_header(fp, element_type, kind):
+    """Reads and checks the common header of an element, returns its name"""
     current_location = fp.tell()
+    header = _read_array(fp, _ELEMENT_DTYPE, 1)[0]
+    if header['location'] != current_location:
+        raise RuntimeError('{:s} location is invalid'.format(kind))
+    if header['element_type'] != element_type:
+        raise RuntimeError('Element type is invalid for {:s}'.format(kind.lower()))
+    name_length = int(header['name_length'])
+    read_bytes = fp.read(name_length + 8) # Name and parent location
+    return read_bytes[:name_length].decode('utf-8')
 
-    group_location = struct.unpack('@Q', fp.read(8))[0]
-    if group_location != current_location:
-        raise RuntimeError('Group location is invalid')
-    element_type = struct.unpack('@B', fp.read(1))[0]
-    if element_type != 0:
-        raise RuntimeError('Element type is invalid for group')
-    name_length = struct.unpack('@H', fp.read(2))[0]
-    name = struct.unpack('@{:d}s'.format(name_length), fp.read(name_length))[0].decode('utf-8')
-    parent = struct.unpack('@Q', fp.read(8))[0]
-
-    if name == '/':
-        data = _read_linked_list(fp, {})
-    else:
-        data[name] = _read_linked_list(fp, {})
-    return data
+def _read_dimensions(fp):
+    num_dimensions = int(_read_array(fp, np.uint8, 1)[0])
+    dimensions = tuple(int(d) for d in _read_array(fp, np.uint64, num_dimensions))
+    data_type = int(_read_array(fp, np.uint8, 1)[0])
+    return dimensions, data_type
 
-def _read_linked_list(fp, data={}):
-    next_location = struct.unpack('@Q', fp.read(8))[0]
-    previous_location = struct.unpack('@Q', fp.read(8))[0]
-    max_entries = struct.unpack('@Q', fp.read(8))[0]
-    num_contents = struct.unpack('@Q', fp.read(8))[0]
-    if num_contents > max_entries:
+def _read_linked_list_header(fp):
+    """Returns the next location and the child locations of a linked list entry"""
+    header = _read_array(fp, _LINKED_LIST_DTYPE, 1)[0]
+    if header['num_contents'] > header['max_entries']:
         raise RuntimeError('Number of contents for linked list exceeds max entries')
-    child_locations = struct.unpack('@{:d}Q'.format(num_contents), fp.read(8*num_contents))
-
-    for i in range(0, num_contents):
-        fp.seek(child_locations[i])
-        child_location = struct.unpack('@Q', fp.read(8))[0]
-        if child_location != child_locations[i]:
-            raise RuntimeError('Child location is invalid')
-        child_element_type = struct.unpack('@B', fp.read(1))[0]
-        fp.seek(child_locations[i])
-        if child_element_type == 0:
-            data = _read_group(fp, data)
-        elif child_element_type == 1:
-            data = _read_attribute(fp, data)
-        else:
-            data = _read_dataset(fp, data) 
-    # Load the next set of entries in our list
-    if next_location > 0:
-        fp.seek(next_location)
-        data = _read_linked_list(fp, data)
-    return data
+    return int(header['next']), _read_array(fp, np.uint64, int(header['num_contents']))
+
+def _read_group(fp, lazy=False, threads=1):
+    """Reads the group at the current position and everything below it
+
+    The tree is walked iteratively with an explicit stack (long linked lists and deep
+    trees do not recurse) and every group gets a new dictionary, which is inserted in its
+    parent when the group is found so that the order of the entries is preserved.
+    With threads > 1 the groups referenced by pointer datasets are read afterwards by a
+    thread pool, each thread with its own positional reader of the same file.
+    Returns (name of the group, dictionary of its contents)
+    """
+    name = _read_element_header(fp, 0, 'Group')
+    contents = {}
+    if threads > 1 and hasattr(os, 'pread'):
+        pointers = []
+        _walk(fp, [(fp.tell(), contents)], lazy, pointers)
+        if len(pointers) > 0:
+            def read_pointed(items):
+                _walk(_PositionalFile(fp.fileno(), fp.name), items[::-1], lazy)
+            # The dictionaries of the pointed groups already are in place, so the order is deterministic
+            batch = max(1, len(pointers) // (4 * threads))
+            with ThreadPoolExecutor(threads) as pool:
+                list(pool.map(read_pointed, [pointers[i:i + batch] for i in range(0, len(pointers), batch)]))
+    else:
+        _walk(fp, [(fp.tell(), contents)], lazy)
+    return name, contents
+
+def _walk(fp, pending, lazy, pointers=None):
+    """Reads the linked lists in pending (location of the list, dictionary receiving its entries)
+
+    Groups referenced by pointer datasets are added to pointers if it is given (to be read
+    later), otherwise they are read as well.
+    """
+    if pointers is None:
+        pointers = pending
+    while len(pending) > 0:
+        next_location, data = pending.pop()
+        while next_location > 0:
+            fp.seek(next_location)
+            next_location, child_locations = _read_linked_list_header(fp)
+            for child_location in child_locations:
+                fp.seek(int(child_location))
+                header = _read_array(fp, _ELEMENT_DTYPE, 1)[0]
+                if header['location'] != child_location:
+                    raise RuntimeError('Child location is invalid')
+                fp.seek(int(child_location))
+                if header['element_type'] == 0:
+                    child_name = _read_element_header(fp, 0, 'Group')
+                    data[child_name] = {}
+                    pending.append((fp.tell(), data[child_name]))
+                elif header['element_type'] == 1:
+                    _read_attribute(fp, data)
+                else:
+                    _read_dataset(fp, data, lazy, pointers)
 
 def _data_type_to_struct_symbol(data_type):
     if data_type == 0:
@@ -108,52 +196,55 @@ def _data_type_to_struct_symbol(data_type):
     elif data_type == 11:
         return ('Q', 8, np.uint64) # pointer (uint64_t)
 
-def _read_attribute(fp, data={}):
-    current_location = fp.tell()
-    location = struct.unpack('@Q', fp.read(8))[0]
-    if location != current_location:
-        raise RuntimeError('Attribute location is invalid')
-    element_type = struct.unpack('@B', fp.read(1))[0]
-    if element_type != 1:
-        raise RuntimeError('Element type is invalid for attribute')
-    name_length = struct.unpack('@H', fp.read(2))[0]
-    name = struct.unpack('@{:d}s'.format(name_length), fp.read(name_length))[0].decode('utf-8')
-    parent = struct.unpack('@Q', fp.read(8))[0]
-    num_dimensions = int(struct.unpack('@B', fp.read(1))[0])
-    dimensions = struct.unpack('@{:d}Q'.format(num_dimensions), fp.read(8*num_dimensions))
-    data_type = struct.unpack('@B', fp.read(1))[0]
-    total_elements = 1
-    for i in range(0, num_dimensions):
-        total_elements *= dimensions[i]
-    struct_symbol, size, _ = _data_type_to_struct_symbol(data_type)
-    data[name] = struct.unpack('@{:d}{:s}'.format(total_elements, struct_symbol), fp.read(size * total_elements))
+def _read_attribute(fp, data):
+    name = _read_element_header(fp, 1, 'Attribute')
+    dimensions, data_type = _read_dimensions(fp)
+    total_elements = int(np.prod(dimensions, dtype=np.int64))
     if data_type == 10: # string
-        data[name] = data[name][0].decode('utf-8')
+        data[name] = fp.read(total_elements).decode('utf-8')
     else:
-        data[name] = np.array(data[name])
+        _, _, dtype = _data_type_to_struct_symbol(data_type)
+        # Attributes are small, keep the default numpy types of the values (int64, float64)
+        data[name] = np.array(_read_array(fp, dtype, total_elements).tolist())
         data[name] = np.reshape(data[name], dimensions)
     
     return data
 
-def _read_dataset(fp, data={}):
-    current_location = fp.tell()
-    location = struct.unpack('@Q', fp.read(8))[0]
-    if location != current_location:
-        raise RuntimeError('Dataset location is invalid')
-    element_type = struct.unpack('@B', fp.read(1))[0]
-    if element_type != 2:
-        raise RuntimeError('Element type is invalid for dataset')
-    name_length = struct.unpack('@H', fp.read(2))[0]
-    name = struct.unpack('@{:d}s'.format(name_length), fp.read(name_length))[0].decode('utf-8')
-    parent = struct.unpack('@Q', fp.read(8))[0]
-    num_dimensions = int(struct.unpack('@B', fp.read(1))[0])
-    dimensions = struct.unpack('@{:d}Q'.format(num_dimensions), fp.read(8*num_dimensions))
-    data_type = struct.unpack('@B', fp.read(1))[0]
-    long_dimension = struct.unpack('@Q', fp.read(8))[0]
-    data[name] = _read_dataset_linked_list(fp, dimensions, long_dimension, data_type)
+def _read_dataset(fp, data, lazy, pointers):
+    name = _read_element_header(fp, 2, 'Dataset')
+    dimensions, data_type = _read_dimensions(fp)
+    long_dimension = int(_read_array(fp, np.uint64, 1)[0])
+    if lazy and data_type != 11:
+        data[name] = _index_dataset_linked_list(fp, dimensions, long_dimension, data_type)
+    else:
+        data[name] = _read_dataset_linked_list(fp, dimensions, long_dimension, data_type, pointers)
     return data
 
-def _read_dataset_linked_list(fp, dimensions, long_dimension, data_type):
+def _index_dataset_linked_list(fp, dimensions, long_dimension, data_type):
+    """Records the location of the chunks of a dataset without reading them"""
+    _, _, dtype = _data_type_to_struct_symbol(data_type)
+    chunks = []
+    index = 0
+    while True:
+        next_location, child_locations = _read_linked_list_header(fp)
+        for child_location in child_locations:
+            fp.seek(int(child_location))
+            long_axis = int(_read_array(fp, np.uint64, 1)[0])
+            if index + long_axis > long_dimension:
+                raise RuntimeError('Dataset chunks exceed the long dimension')
+            chunks.append((int(child_location) + 8, index, long_axis))
+            index = index + long_axis
+        if next_location == 0:
+            break
+        fp.seek(next_location)
+    return LazyDataset(fp.name, dimensions, long_dimension, dtype, chunks)
+
+def _read_dataset_linked_list(fp, dimensions, long_dimension, data_type, pointers):
+    """Reads the chunks of a dataset
+
+    Pointer datasets get a new dictionary per pointed group, the contents of the groups are
+    added to pointers (see _walk) and read by the caller.
+    """
     total_dimensions = list(dimensions)
     total_dimensions.append(long_dimension)
     struct_symbol, size, dtype = _data_type_to_struct_symbol(data_type)
@@ -163,31 +254,26 @@ def _read_dataset_linked_list(fp, dimensions, long_dimension, data_type):
         data = [None for i in range(np.prod(total_dimensions))]
     index = 0
     while True:
-        next_location = struct.unpack('@Q', fp.read(8))[0]
-        previous_location = struct.unpack('@Q', fp.read(8))[0]
-        max_entries = struct.unpack('@Q', fp.read(8))[0]
-        num_contents = struct.unpack('@Q', fp.read(8))[0]
-        if num_contents > max_entries:
-            raise RuntimeError('Number of contents for linked list exeeds max entries')
-        child_locations = struct.unpack('@{:d}Q'.format(num_contents), fp.read(8*num_contents))
-
-        for i in range(0, num_contents):
-            fp.seek(child_locations[i])
-            long_axis = struct.unpack('@Q', fp.read(8))[0]
-            total_data = long_axis
-            for j in range(0, len(dimensions)):
-                total_data *= dimensions[j]
-            temp = np.array(struct.unpack('@{:d}{:s}'.format(total_data, struct_symbol), fp.read(total_data * size)))
+        next_location, child_locations = _read_linked_list_header(fp)
+
+        for child_location in child_locations:
+            fp.seek(int(child_location))
+            long_axis = int(_read_array(fp, np.uint64, 1)[0])
+            if index + long_axis > long_dimension:
+                raise RuntimeError('Dataset chunks exceed the long dimension')
             if data_type == 11:  # This is a pointer
+                temp = _read_array(fp, np.uint64, long_axis * int(np.prod(dimensions, dtype=np.int64)))
                 for j in range(0, len(temp)):
-                    fp.seek(temp[j])
-                    sub_group = _read_group(fp, data={})
-                    data[index+j] = sub_group[list(sub_group)[0]]
+                    fp.seek(int(temp[j]))
+                    _read_element_header(fp, 0, 'Group')
+                    data[index+j] = {}
+                    pointers.append((fp.tell(), data[index+j]))
+            elif len(dimensions) == 0:
+                _read_into(fp, data[index:index+long_axis]) # Contiguous, read in place
             else:
                 new_dimensions = list(dimensions)
                 new_dimensions.append(long_axis)
-                temp = np.reshape(temp, new_dimensions)
-                data[..., index:index+long_axis] = temp
+                data[..., index:index+long_axis] = _read_into(fp, np.empty(new_dimensions, dtype=dtype))
             index = index + long_axis
         if next_location == 0:
             break
@@ -195,7 +281,388 @@ def _read_dataset_linked_list(fp, dimensions, long_dimension, data_type):
             fp.seek(next_location)
     return data
 
+class LazyDataset():
+    """A dataset of an FHD file that is only read when it is indexed
+
+    Datasets are stored as a list of chunks along their long (last) dimension. Indexing
+    memory-maps the chunks that overlap the requested range of the long dimension, the
+    other chunks are never read. ds[...] or np.asarray(ds) reads the whole dataset.
+    """
+    def __init__(self, filename, dimensions, long_dimension, dtype, chunks):
+        """
+        :param chunks: List of (file offset of the data, start along the long dimension, length)
+        """
+        self.filename = filename
+        self.shape = tuple(dimensions) + (long_dimension,)
+        self.dtype = np.dtype(dtype)
+        chunks = [c for c in chunks if c[2] > 0]
+        self.chunk_offsets = np.array([c[0] for c in chunks], dtype=np.int64)
+        self.chunk_starts = np.array([c[1] for c in chunks], dtype=np.int64)
+        self.chunk_lengths = np.array([c[2] for c in chunks], dtype=np.int64)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape, dtype=np.int64))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return '<LazyDataset shape={} dtype={} in {:s}>'.format(self.shape, self.dtype, self.filename)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        for i in range(len(key)):
+            if key[i] is Ellipsis:
+                key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+                break
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) != self.ndim:
+            raise IndexError('Too many indices for a dataset of shape {}'.format(self.shape))
+        selection, last = self._long_selection(key[-1])
+        data = np.zeros(self.shape[:-1] + (len(selection),), dtype=self.dtype)
+        if data.size > 0 and len(self.chunk_starts) > 0:
+            chunk = np.searchsorted(self.chunk_starts, selection, side='right') - 1
+            inside = (chunk >= 0) & (selection - self.chunk_starts[chunk] < self.chunk_lengths[chunk])
+            for i in np.unique(chunk[inside]):
+                where = np.flatnonzero(inside & (chunk == i))
+                values = np.memmap(self.filename, dtype=self.dtype, mode='r', offset=int(self.chunk_offsets[i]),
+                                   shape=self.shape[:-1] + (int(self.chunk_lengths[i]),))
+                data[..., where] = values[..., selection[where] - self.chunk_starts[i]]
+                del values
+        return data[key[:-1] + (last,)]
+
+    def _long_selection(self, key):
+        """Positions to read along the long dimension and the index into them equivalent to key
+
+        Only the positions that are read are built (never an index over the whole long dimension),
+        the full key is then applied by numpy so several advanced indices broadcast as in numpy.
+        :param key: Index along the long dimension (slice, integer or index array)
+        :return: (sorted positions to read, index into the positions read)
+        """
+        length = self.shape[-1]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(length)
+            positions = np.arange(start, stop, step, dtype=np.int64)
+            if step < 0:
+                return positions[::-1], slice(None, None, -1)
+            return positions, slice(None)
+        if isinstance(key, (int, np.integer)) and not isinstance(key, (bool, np.bool_)):
+            if not -length <= key < length:
+                raise IndexError('Index {} is out of bounds for the long dimension of size {}'.format(key, length))
+            return np.array([key % length], dtype=np.int64), 0
+        key = np.asarray(key)
+        if key.dtype == bool:
+            if key.shape != (length,):
+                raise IndexError('Boolean index of shape {} does not match the long dimension of size {}'.format(
+                    key.shape, length))
+            positions = np.flatnonzero(key)
+            return positions, np.arange(len(positions))
+        if key.size == 0:
+            key = key.astype(np.int64)
+        if key.dtype.kind not in 'iu':
+            raise IndexError('Arrays used as indices must be of integer or boolean type')
+        if key.size > 0 and (key.min() < -length or key.max() >= length):
+            raise IndexError('Index out of bounds for the long dimension of size {}'.format(length))
+        positions = np.where(key < 0, key + length, key).astype(np.int64)
+        if key.ndim == 0:
+            return positions.reshape(1), 0
+        if key.ndim == 1 and np.all(positions[1:] > positions[:-1]):
+            return positions, np.arange(len(positions))
+        selection, inverse = np.unique(positions, return_inverse=True)
+        return selection, inverse.reshape(key.shape)
+
+
+# Data type codes of numpy types (see _data_type_to_struct_symbol), booleans are stored as uint8
+_DATA_TYPE_CODES = {'f8': 0, 'f4': 1, 'u1': 2, 'u2': 3, 'u4': 4, 'u8': 5, 'i1': 6, 'i2': 7, 'i4': 8, 'i8': 9, 'b1': 2}
+
+def _data_type_code(dtype):
+    dtype = np.dtype(dtype)
+    key = '{:s}{:d}'.format(dtype.kind, dtype.itemsize)
+    if key not in _DATA_TYPE_CODES:
+        raise ValueError('Data type {} cannot be stored in an FHD file'.format(dtype))
+    return _DATA_TYPE_CODES[key]
+
+def save(filename, data, max_entries=64):
+    """Save a dictionary to an FHD file
+
+    Dictionaries are stored as groups, numpy arrays as datasets, lists of dictionaries
+    as pointer datasets and anything else (strings, scalars) as attributes.
+    """
+    with Writer(filename, 'w', max_entries) as writer:
+        writer.write('/', data)
+
+class Writer():
+    """Writes FHD files
+
+    Datasets grow along their long (last) dimension: every append writes one chunk at
+    the end of the file and links it into the dataset, nothing already written is moved,
+    so streaming outputs are written in bounded memory.
+
+    with Writer('out.fhd') as writer:
+        writer.set_attribute('session/subject', 'M1')
+        writer.create_dataset('session/eye', dims=(2,), dtype=np.float32)
+        for block in blocks:
+            writer.append('session/eye', block) # [2, n] samples
+    """
+    def __init__(self, filename, mode='w', max_entries=64):
+        """
+        :param mode: 'w' creates a new file, 'a' appends to an existing file
+        :param max_entries: Number of entries of the linked list nodes (the lists grow
+        by one node whenever a node is full)
+        """
+        self.filename = filename
+        self.max_entries = int(max_entries)
+        self._groups = {} # path -> {'location', 'list', 'names'}
+        self._datasets = {} # path -> {'location', 'dims', 'data_type', 'long_dimension', 'long_dimension_location', 'list'}
+        if mode == 'w':
+            self._fp = open(filename, 'w+b')
+            self._fp.write(b'fhd\x00' + bytes([1, 0, 0, 8, min(self.max_entries, 255)]) + bytes(1015))
+            self._end = 1024
+            self._groups[''] = self._write_group('/', 0)
+        elif mode == 'a':
+            if not os.path.isfile(filename):
+                raise RuntimeError('File {:s} does not exist'.format(filename))
+            self._fp = open(filename, 'r+b')
+            _read_header(self._fp)
+            self._end = self._fp.seek(0, os.SEEK_END)
+            self._scan()
+        else:
+            raise ValueError('Unknown mode {}'.format(mode))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def flush(self):
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+    def create_group(self, path):
+        """Creates a group (and its missing parents), returns its path"""
+        path = path.strip('/')
+        if path in self._groups:
+            return path
+        parent, name = self._split(path)
+        group = self._groups[self.create_group(parent)]
+        self._check_name(group, name, path)
+        self._groups[path] = self._write_group(name, group['location'])
+        self._link(group, self._groups[path]['location'])
+        return path
+
+    def set_attribute(self, path, value):
+        """Stores value (string, scalar or array) as an attribute"""
+        parent, name = self._split(path)
+        group = self._groups[self.create_group(parent)]
+        self._check_name(group, name, path)
+        location = self._write_element_header(1, name, group['location'])
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+            self._write(self._pack_dimensions((len(value),), 10) + value)
+        else:
+            value = np.asarray(value)
+            data_type = _data_type_code(value.dtype)
+            _, _, dtype = _data_type_to_struct_symbol(data_type)
+            self._write(self._pack_dimensions(value.shape, data_type) +
+                        np.ascontiguousarray(value, dtype=dtype).tobytes())
+        self._link(group, location)
+
+    def create_dataset(self, path, data=None, dims=None, dtype=None):
+        """Creates a dataset, either from data (its last dimension is the long dimension)
+        or empty with the leading dimensions dims and the given dtype
+        """
+        if data is not None:
+            data = np.asarray(data)
+            if data.ndim == 0:
+                raise ValueError('Datasets need at least one dimension')
+            dims, dtype = data.shape[:-1], data.dtype
+        elif dtype is None:
+            raise ValueError('Either data or dtype must be given')
+        self._create_dataset(path, tuple(dims or ()), _data_type_code(dtype))
+        if data is not None and data.shape[-1] > 0:
+            self.append(path, data)
+        return path
+
+    def create_pointer_dataset(self, path, groups=()):
+        """Creates a dataset of pointers to groups, given as a list of dictionaries
+        (loaded as a list of dictionaries)
+        """
+        self._create_dataset(path, (), 11)
+        if len(groups) > 0:
+            self.append(path, groups)
+        return path
+
+    def append(self, path, data):
+        """Appends a chunk along the long dimension of a dataset
+
+        data has the shape dims + [n] (or [n] for datasets without leading dimensions),
+        or is a list of dictionaries for pointer datasets.
+        """
+        dataset = self._datasets[path.strip('/')]
+        if dataset['data_type'] == 11:
+            pointers = [self._write_detached_group(str(dataset['long_dimension'] + i), contents, dataset['location'])
+                        for i, contents in enumerate(data)]
+            data = np.array(pointers, dtype=np.uint64)
+        else:
+            _, _, dtype = _data_type_to_struct_symbol(dataset['data_type'])
+            data = np.asarray(data)
+            if data.ndim == len(dataset['dims']):
+                data = data[..., np.newaxis] # A single sample
+            if data.shape[:-1] != dataset['dims']:
+                raise ValueError('Chunk of shape {} does not match the dataset dimensions {}'.format(data.shape, dataset['dims']))
+            data = np.ascontiguousarray(data, dtype=dtype)
+        long_axis = data.shape[-1]
+        if long_axis == 0:
+            return
+        # Chunk, then the new length, then the link: an interrupted append leaves a readable file
+        location = self._write(struct.pack('@Q', long_axis) + data.tobytes())
+        dataset['long_dimension'] += long_axis
+        self._write_at(dataset['long_dimension_location'], struct.pack('@Q', dataset['long_dimension']))
+        self._link(dataset, location)
+
+    def write(self, path, data):
+        """Writes the contents of a dictionary in the group path (see save)"""
+        path = self.create_group(path)
+        for name in data:
+            value = data[name]
+            child = path + '/' + name if path else name
+            if isinstance(value, dict):
+                self.write(child, value)
+            elif isinstance(value, (list, tuple)) and len(value) > 0 and all(isinstance(v, dict) for v in value):
+                self.create_pointer_dataset(child, value)
+            elif isinstance(value, np.ndarray) and value.ndim > 0:
+                self.create_dataset(child, value)
+            else:
+                self.set_attribute(child, value)
+
+    def _split(self, path):
+        path = path.strip('/')
+        if path == '':
+            raise ValueError('Invalid name {}'.format(path))
+        parent, _, name = path.rpartition('/')
+        return parent, name
+
+    def _check_name(self, group, name, path):
+        if name in group['names']:
+            raise ValueError('{:s} already exists'.format(path))
+        group['names'].add(name)
+
+    def _write(self, data):
+        """Writes data at the end of the file, returns its location"""
+        location = self._end
+        self._fp.seek(location)
+        self._fp.write(data)
+        self._end += len(data)
+        return location
+
+    def _write_at(self, location, data):
+        self._fp.seek(location)
+        self._fp.write(data)
+
+    def _pack_dimensions(self, dims, data_type):
+        return struct.pack('@B', len(dims)) + struct.pack('@{:d}Q'.format(len(dims)), *dims) + struct.pack('@B', data_type)
+
+    def _write_element_header(self, element_type, name, parent):
+        name = name.encode('utf-8')
+        location = self._end
+        self._write(struct.pack('@Q', location) + struct.pack('@B', element_type) + struct.pack('@H', len(name)) +
+                    name + struct.pack('@Q', parent))
+        return location
+
+    def _write_list_node(self, previous):
+        """Writes an empty linked list node, returns its description"""
+        location = self._write(struct.pack('@4Q', 0, previous, self.max_entries, 0) + bytes(8 * self.max_entries))
+        return {'tail': location, 'num': 0, 'max': self.max_entries}
+
+    def _link(self, element, location):
+        """Adds location to the linked list of a group or dataset, growing the list when its last node is full"""
+        entries = element['list']
+        if entries['num'] >= entries['max']:
+            node = self._write_list_node(entries['tail'])
+            self._write_at(entries['tail'], struct.pack('@Q', node['tail'])) # next of the previous node
+            entries.update(node)
+        self._write_at(entries['tail'] + 32 + 8 * entries['num'], struct.pack('@Q', location))
+        entries['num'] += 1
+        self._write_at(entries['tail'] + 24, struct.pack('@Q', entries['num']))
+
+    def _write_group(self, name, parent):
+        location = self._write_element_header(0, name, parent)
+        return {'location': location, 'list': self._write_list_node(0), 'names': set()}
+
+    def _write_detached_group(self, name, contents, parent):
+        """Writes a group that is only referenced by a pointer, returns its location"""
+        group = self._write_group(name, parent)
+        path = '\0{:d}'.format(group['location']) # Internal path, not reachable from the root
+        self._groups[path] = group
+        self.write(path, contents)
+        return group['location']
+
+    def _create_dataset(self, path, dims, data_type):
+        parent, name = self._split(path)
+        group = self._groups[self.create_group(parent)]
+        self._check_name(group, name, path)
+        location = self._write_element_header(2, name, group['location'])
+        self._write(self._pack_dimensions(dims, data_type))
+        long_dimension_location = self._write(struct.pack('@Q', 0))
+        self._datasets[path.strip('/')] = {'location': location, 'dims': dims, 'data_type': data_type,
+                                           'long_dimension': 0, 'long_dimension_location': long_dimension_location,
+                                           'list': self._write_list_node(0)}
+        self._link(group, location)
+
+    def _scan(self):
+        """Indexes the groups and datasets of an existing file (append mode)"""
+        fp = self._fp
+        fp.seek(1024)
+        _read_element_header(fp, 0, 'Group')
+        pending = [('', 1024, fp.tell())]
+        while len(pending) > 0:
+            path, location, list_location = pending.pop()
+            group = {'location': location, 'list': None, 'names': set()}
+            self._groups[path] = group
+            for child_location in self._scan_list(group, list_location):
+                fp.seek(child_location)
+                header = _read_array(fp, _ELEMENT_DTYPE, 1)[0]
+                fp.seek(child_location)
+                child_name = _read_element_header(fp, int(header['element_type']), 'Element')
+                child = path + '/' + child_name if path else child_name
+                group['names'].add(child_name)
+                if header['element_type'] == 0:
+                    pending.append((child, child_location, fp.tell()))
+                elif header['element_type'] == 2:
+                    dims, data_type = _read_dimensions(fp)
+                    long_dimension_location = fp.tell()
+                    dataset = {'location': child_location, 'dims': dims, 'data_type': data_type,
+                               'long_dimension': int(_read_array(fp, np.uint64, 1)[0]),
+                               'long_dimension_location': long_dimension_location, 'list': None}
+                    self._scan_list(dataset, fp.tell())
+                    self._datasets[child] = dataset
+
+    def _scan_list(self, element, location):
+        """Finds the last node of the linked list at location, returns all its entries"""
+        fp = self._fp
+        entries = []
+        while True:
+            fp.seek(location)
+            header = _read_array(fp, _LINKED_LIST_DTYPE, 1)[0]
+            entries.extend(int(c) for c in _read_array(fp, np.uint64, int(header['num_contents'])))
+            element['list'] = {'tail': location, 'num': int(header['num_contents']), 'max': int(header['max_entries'])}
+            if header['next'] == 0:
+                return entries
+            location = int(header['next'])
+
 
 if __name__ == '__main__':
     load(sys.argv[1])
-     
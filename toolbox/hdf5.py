@@ -5,12 +5,18 @@ Written by David J. Herzfeld <herzfeldd@gmail.com>
 """
 
 import h5py as h5
+import multiprocessing
+import operator
 import os
 import sys
 import numpy as np
 import pickle
+import threading
+from contextlib import contextmanager
+from queue import Empty, Full
 
-def hdf5_save_object(x, file, group=None, name=None, raise_error=True):
+def hdf5_save_object(x, file, group=None, name=None, raise_error=True, columnar=False, policy=None,
+                     progress=None):
     """Save the contents of this hdf5 file to an hdf5 file
 
     Saves an object to a new HDF5 file. If the output file exists, the file is overwritten without
@@ -20,12 +26,21 @@ def hdf5_save_object(x, file, group=None, name=None, raise_error=True):
 
     If an object defines a hook __hdf5_save__, then that function is called instead of this
     generic function. This allows a class to override the behavior of this function (and possibly
-    omit or add extra data to the HDF5 file).
+    omit or add extra data to the HDF5 file). Classes that cannot define the hook can register
+    custom serializers instead (see register_hdf5_type).
 
     :param x: is an instance of a class (something that inherits from object)
     :param file: A file object for an open HDF5 file. Otherwise, if this variable is a string, then
     we use this as the name HDF5 file.
     :param group: The current HDF5 group (or None if we should write to the root of the HDF5 file, '/')
+    :param columnar: If True, homogeneous lists (objects of the same class, dictionaries with the
+    same keys, arrays of different lengths) are stored by columns: one dataset per attribute
+    instead of one group per element (see _hdf5_save_columns), and are loaded back as lists.
+    Heterogeneous lists are saved element by element as before.
+    :param policy: StoragePolicy deciding the chunking and compression of the datasets (default
+    None: contiguous, uncompressed datasets)
+    :param progress: A function progress(name, index, count) called after each element of a list
+    of objects has been saved (e.g. hdf5_print_progress), to follow the saving of long lists
     """
 
     # If this is a string, open a new HDF5 file
@@ -45,24 +60,29 @@ def hdf5_save_object(x, file, group=None, name=None, raise_error=True):
 
     if isinstance(x, bool) or isinstance(x, int) or isinstance(x, float) \
             or isinstance(x, list) or isinstance(x, tuple) or isinstance(x, np.ndarray) \
-            or isinstance(x, np.floating) or isinstance(x, bytes) or isinstance(x, np.integer) \
-            or isinstance(x, np.bool_):
-        _hdf5_save_item(x, name, file=file, group=group)
+            or isinstance(x, np.floating) or isinstance(x, bytes) or isinstance(x, str) or isinstance(x, np.integer) \
+            or isinstance(x, np.bool_) or x is None:
+        _hdf5_save_item(x, name, file=file, group=group, columnar=columnar, policy=policy, progress=progress)
     elif isinstance(x, dict):
         if name is not None:
             group = group.create_group(name)
         for key in x.keys():
-            hdf5_save_object(x[key], name=key, file=file, group=group)
+            hdf5_save_object(x[key], name=key, file=file, group=group, columnar=columnar, policy=policy,
+                             progress=progress)
     else:  # This is a class, which we have to save
         if name is not None:
             group = group.create_group(name)  # New sub-group
         # Save the class name
         group.attrs['__class__'] = np.void(pickle.dumps(x.__class__))
 
-        # Check if this object defines the hook __hdf5_save__
+        # Check if this object defines the hook __hdf5_save__ (or has a registered serializer)
         if hasattr(x, '__hdf5_save__'):
             x.__hdf5_save__(file, group)
             return  # Nothing else to do
+        handler = _hdf5_type_handler(type(x))
+        if handler is not None:
+            handler[0](x, file, group)
+            return
 
         # Get a list of all attributes of this class (that are not properties)
         try:
@@ -74,12 +94,124 @@ def hdf5_save_object(x, file, group=None, name=None, raise_error=True):
             # Skip saving any variables that are attributes of this class
             if isinstance(getattr(type(x), attribute, None), property):
                 continue  # This is a class property, no need to save it
-            hdf5_save_object(getattr(x, attribute), name=attribute, file=file, group=group)
+            hdf5_save_object(getattr(x, attribute), name=attribute, file=file, group=group, columnar=columnar,
+                             policy=policy, progress=progress)
 
     if close_file:
         file.close()  # Close the file, all done
 
-def _hdf5_save_known_type(x, name, file, group):
+# Custom serializers registered with register_hdf5_type, class -> (save, load)
+_HDF5_TYPE_HANDLERS = {}
+
+def register_hdf5_type(cls, save, load=None):
+    """Registers custom serializers for the instances of cls (and of its subclasses)
+
+    This works like the __hdf5_save__ and __hdf5_load__ hooks, for classes that cannot (or
+    should not) define them, e.g. to save only the results of a SimpleSpikeSorter:
+        register_hdf5_type(SimpleSpikeSorter, lambda x, file, group: hdf5_save_object(
+            collect_results(x), file, group))
+    :param save: save(x, file, group) writes x into the group (its __class__ attribute is already set)
+    :param load: load(file, group) returns the object saved in the group. If None, the group is
+    loaded like any other object (its attributes are set on an uninitialized instance of cls).
+    """
+    _HDF5_TYPE_HANDLERS[cls] = (save, load)
+
+def unregister_hdf5_type(cls):
+    """Removes the serializers registered for cls"""
+    _HDF5_TYPE_HANDLERS.pop(cls, None)
+
+def _hdf5_type_handler(cls):
+    if not _HDF5_TYPE_HANDLERS:
+        return None
+    for c in getattr(cls, '__mro__', ()):
+        if c in _HDF5_TYPE_HANDLERS:
+            return _HDF5_TYPE_HANDLERS[c]
+    return None
+
+def hdf5_print_progress(name, index, count):
+    """Progress callback for hdf5_save_object printing the number of saved elements of each list"""
+    print('saving {:s}: {:d}/{:d}'.format(name, index, count))
+
+class StoragePolicy():
+    """ Chunking and compression of the datasets written by hdf5_save_object
+
+    Arrays smaller than min_size bytes (or whose dtype kind is not in kinds) are stored
+    contiguously, which is fastest for small arrays. Larger arrays are chunked for reads of
+    time ranges: a chunk spans all the other axes and about chunk_size bytes along the time
+    axis (by default the longest axis), and is compressed with the given filter.
+    """
+    def __init__(self, min_size=1 << 20, compression='lzf', compression_opts=None, shuffle=True,
+                 chunk_size=1 << 16, time_axis=None, kinds='iuf'):
+        """
+        Object constructor
+        :param compression: HDF5 filter ('lzf', 'gzip') or None for chunking without compression
+        :param compression_opts: Filter options (e.g. the gzip level, 0 - 9)
+        :param shuffle: Apply the byte shuffle filter before compressing (helps integer data)
+        :param time_axis: Axis along which arrays are read in ranges (None: the longest axis)
+        :param kinds: numpy dtype kinds ('i', 'u', 'f', 'b', ...) that may be chunked/compressed
+        """
+        self.min_size = min_size
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.chunk_size = chunk_size
+        self.time_axis = time_axis
+        self.kinds = kinds
+
+    def options(self, x):
+        """Returns the create_dataset keyword arguments for the array x"""
+        if x.ndim == 0 or x.nbytes < self.min_size or x.dtype.kind not in self.kinds:
+            return {}
+        axis = int(np.argmax(x.shape)) if self.time_axis is None else self.time_axis % x.ndim
+        chunks = list(x.shape)
+        chunks[axis] = 1
+        # Shrink the other axes when a single time step is already larger than a chunk
+        while np.prod(chunks) * x.dtype.itemsize > self.chunk_size and max(chunks) > 1:
+            largest = int(np.argmax(chunks))
+            chunks[largest] = (chunks[largest] + 1) // 2
+        chunks[axis] = int(min(x.shape[axis], max(1, self.chunk_size // (np.prod(chunks) * x.dtype.itemsize))))
+        options = {'chunks': tuple(chunks)}
+        options.update(self._filters())
+        return options
+
+    def resizable_options(self, x):
+        """Returns the create_dataset keyword arguments for the array x growing along its first axis
+
+        Resizable datasets are always chunked (whatever their size), a chunk holds complete rows.
+        """
+        row = tuple(max(1, n) for n in x.shape[1:])
+        row_size = int(np.prod(row)) * x.dtype.itemsize
+        options = {'maxshape': (None,) + x.shape[1:], 'chunks': (max(1, self.chunk_size // row_size),) + row}
+        if x.dtype.kind in self.kinds:
+            options.update(self._filters())
+        return options
+
+    def _filters(self):
+        if self.compression is None:
+            return {}
+        options = {'compression': self.compression, 'shuffle': self.shuffle}
+        if self.compression_opts is not None:
+            options['compression_opts'] = self.compression_opts
+        return options
+
+    def __repr__(self):
+        return 'StoragePolicy(min_size={}, compression={}, compression_opts={}, shuffle={}, chunk_size={})'.format(
+            self.min_size, self.compression, self.compression_opts, self.shuffle, self.chunk_size)
+
+
+# Common policies, None keeps all datasets contiguous and uncompressed
+STORAGE_POLICIES = {'contiguous': None,
+                    'chunked': StoragePolicy(compression=None),
+                    'lzf': StoragePolicy(compression='lzf'),
+                    'gzip': StoragePolicy(compression='gzip', compression_opts=4)}
+
+
+def _hdf5_create_dataset(group, name, x, policy=None):
+    if policy is None:
+        return group.create_dataset(name, data=x)
+    return group.create_dataset(name, data=x, **policy.options(np.asarray(x)))
+
+def _hdf5_save_known_type(x, name, file, group, policy=None):
     """Saves a basic type
 
     This function returns True if savings was successful, otherwise false
@@ -92,10 +224,13 @@ def _hdf5_save_known_type(x, name, file, group):
     elif isinstance(x, bytes):
         group.attrs[name] = str(x)
         return True
-    # Save numpy arrays/matrices (no chunking as it slows access times)
+    elif isinstance(x, str):
+        group.attrs[name] = x
+        return True
+    # Save numpy arrays/matrices (contiguous unless the storage policy chunks them)
     elif isinstance(x, np.ndarray) and x.dtype != np.dtype(object):
         # Save the nd-array
-        group.create_dataset(name, data=x)
+        _hdf5_create_dataset(group, name, x, policy)
         return True
     elif x is None:  # Save none-types
         group.attrs[name] = np.empty((0,))  # h5.Empty("f")  # Empty
@@ -105,15 +240,21 @@ def _hdf5_save_known_type(x, name, file, group):
         try:
             x = np.array(x)
             if x.dtype != np.dtype(object):
-                group.create_dataset(name, data=x)
+                _hdf5_create_dataset(group, name, x, policy)
                 return True
         except:
             pass
     return False
 
-def _hdf5_save_item(x, name, file, group):
-    if _hdf5_save_known_type(x, name, file, group):
+def _hdf5_save_item(x, name, file, group, columnar=False, policy=None, progress=None):
+    if _hdf5_save_known_type(x, name, file, group, policy):
         return  # Saving successful
+    elif columnar and (isinstance(x, list) or isinstance(x, tuple) or
+                       (isinstance(x, np.ndarray) and x.dtype == np.dtype('object'))) and \
+            _hdf5_save_columns(list(x), name, file, group, policy):
+        if progress is not None:
+            progress(name, len(x), len(x))
+        return  # Homogeneous list saved by columns
     # To save these, we create a list of object references. This is
     # the actual list. Then, the actual data is stored as /path/__name_[index]
     # During the load function, we skip any values that begin with '__'
@@ -124,24 +265,157 @@ def _hdf5_save_item(x, name, file, group):
         dtype = h5.special_dtype(ref=h5.Reference)
         d = np.empty(len(x), dtype=dtype) #group.create_dataset(name, (len(x),), dtype=dtype)
         for i in range(len(x)):
-            import saccades.neuron
-            if isinstance(x[i], saccades.neuron.Neuron):
-                print('saving neuron {:d}'.format(i))
             new_group = group.create_group('__' + name + '_{:d}'.format(i))
-            hdf5_save_object(x[i], file, new_group)
+            hdf5_save_object(x[i], file, new_group, columnar=columnar, policy=policy, progress=progress)
             d[i] = new_group.ref
-            if isinstance(x[i], saccades.neuron.Neuron):
-                print(' -done saving neuron {:d}'.format(i))
+            if progress is not None:
+                progress(name, i + 1, len(x))
         group.create_dataset(name, data=d)
     # Save all other objects
     elif isinstance(x, object):
-        hdf5_save_object(x, file=file, name=name, group=group)
+        hdf5_save_object(x, file=file, name=name, group=group, columnar=columnar, policy=policy,
+                         progress=progress)
     return
 
-def hdf5_load_object(file, group=None):
+def _is_scalar(x):
+    return isinstance(x, (bool, int, float, np.integer, np.floating, np.bool_))
+
+def _as_numeric_array(x):
+    """Returns x as a (non-object) numpy array, or None if it is not numeric data"""
+    if isinstance(x, np.ndarray):
+        return x if x.dtype != np.dtype(object) else None
+    if isinstance(x, list) or isinstance(x, tuple):
+        try:
+            x = np.array(x)
+        except ValueError:
+            return None
+        return x if x.dtype != np.dtype(object) and x.dtype.kind != 'U' else None
+    return None
+
+def _columnar_fields(x):
+    """Returns the attributes of a list of objects of the same class (or of dictionaries with the
+    same keys) as a list of names, or None if the elements differ"""
+    first = x[0]
+    if isinstance(first, dict):
+        fields = list(first.keys())
+        if not all(isinstance(key, str) for key in fields) or \
+                not all(isinstance(y, dict) and list(y.keys()) == fields for y in x):
+            return None
+        return fields
+    if not hasattr(first, '__dict__') or hasattr(first, '__hdf5_save__') or hasattr(first, '__hdf5_load__') or \
+            isinstance(first, (np.ndarray, str, bytes, list, tuple)) or _hdf5_type_handler(type(first)) is not None:
+        return None
+    fields = [key for key in vars(first) if not isinstance(getattr(type(first), key, None), property)]
+    if not all(type(y) is type(first) and list(vars(y).keys()) == list(vars(first).keys()) for y in x):
+        return None
+    return fields
+
+def _hdf5_save_ragged(arrays, name, group, policy=None):
+    """Saves arrays that only differ in their first dimension as values + offsets, returns False otherwise"""
+    if not all(a.ndim > 0 and a.dtype == arrays[0].dtype and a.shape[1:] == arrays[0].shape[1:] for a in arrays):
+        return False
+    new_group = group.create_group(name)
+    new_group.attrs['__columnar__'] = 'ragged'
+    new_group.attrs['__length__'] = len(arrays)
+    _hdf5_create_dataset(new_group, 'values', np.concatenate(arrays, axis=0), policy)
+    new_group.create_dataset('offsets', data=np.concatenate(([0], np.cumsum([len(a) for a in arrays]))).astype(np.int64))
+    return True
+
+def _hdf5_save_columns(x, name, file, group, policy=None):
+    """Saves a homogeneous list by columns
+
+    Layout of the group name (attributes __columnar__ = kind, __length__ = len(x)):
+        'ragged':  arrays that only differ in their first dimension, concatenated in the dataset
+                   values, element i is values[offsets[i]:offsets[i + 1]]
+        'lists':   lists whose concatenation is homogeneous, saved by columns in values,
+                   element i is values[offsets[i]:offsets[i + 1]]
+        'objects': objects of the same class (attribute __class__) and
+        'dicts':   dictionaries with the same keys, with one column per attribute/key
+                   (attribute __fields__ lists them in order). Columns of scalars, strings and
+                   arrays of the same shape are single datasets, arrays of different lengths and
+                   lists of objects are saved as nested columnar groups, other columns element by
+                   element, and columns of None as an empty attribute.
+    Returns False (and saves nothing) if the list is not homogeneous, including when a column
+    mixes None with other values or values of different types (see _uniform_column).
+    """
+    if len(x) == 0:
+        return False
+    arrays = [_as_numeric_array(y) for y in x]
+    if all(a is not None for a in arrays):
+        return _hdf5_save_ragged(arrays, name, group, policy)
+    if all(isinstance(y, list) or isinstance(y, tuple) for y in x):
+        new_group = group.create_group(name)
+        if not _hdf5_save_columns([z for y in x for z in y], 'values', file, new_group, policy):
+            del group[name]
+            return False
+        new_group.attrs['__columnar__'] = 'lists'
+        new_group.attrs['__length__'] = len(x)
+        new_group.create_dataset('offsets', data=np.concatenate(([0], np.cumsum([len(y) for y in x]))).astype(np.int64))
+        return True
+    fields = _columnar_fields(x)
+    if fields is None:
+        return False
+    if isinstance(x[0], dict):
+        columns = [[y[field] for y in x] for field in fields]
+    else:
+        columns = [[getattr(y, field) for y in x] for field in fields]
+    if not all(_uniform_column(column) for column in columns):
+        return False  # Saved object by object instead
+    new_group = group.create_group(name)
+    new_group.attrs['__length__'] = len(x)
+    new_group.attrs['__fields__'] = np.array(fields, dtype=h5.string_dtype())
+    if isinstance(x[0], dict):
+        new_group.attrs['__columnar__'] = 'dicts'
+    else:
+        new_group.attrs['__columnar__'] = 'objects'
+        new_group.attrs['__class__'] = np.void(pickle.dumps(x[0].__class__))
+    for field, column in zip(fields, columns):
+        _hdf5_save_column(column, field, file, new_group, policy)
+    return True
+
+def _uniform_column(column):
+    """True if the values of a column are all None, or all scalars, strings, numeric arrays or
+    instances of the same type (a column mixing None with values cannot be restored)"""
+    if all(y is None for y in column):
+        return True
+    if any(y is None for y in column):
+        return False
+    if all(_is_scalar(y) for y in column) or all(isinstance(y, str) for y in column):
+        return True
+    first = type(column[0])
+    if all(type(y) is first for y in column):
+        return True
+    return all(_as_numeric_array(y) is not None for y in column)
+
+def _hdf5_save_column(column, name, file, group, policy=None):
+    if all(y is None for y in column):
+        group.attrs[name] = np.empty((0,))  # Same marker as a single None
+        return
+    if all(_is_scalar(y) for y in column):
+        _hdf5_create_dataset(group, name, np.array(column), policy)
+        return
+    if all(isinstance(y, str) for y in column):
+        group.create_dataset(name, data=np.array(column, dtype=h5.string_dtype()))
+        return
+    arrays = [_as_numeric_array(y) for y in column]
+    if all(a is not None for a in arrays):
+        if all(a.shape == arrays[0].shape and a.dtype == arrays[0].dtype for a in arrays):
+            _hdf5_create_dataset(group, name, np.stack(arrays), policy)
+            return
+        if _hdf5_save_ragged(arrays, name, group, policy):
+            return
+    if _hdf5_save_columns(column, name, file, group, policy):
+        return
+    _hdf5_save_item(column, name, file, group, columnar=True, policy=policy)  # Heterogeneous, element by element
+
+def hdf5_load_object(file, group=None, lazy=False):
     """Load objects from a HDF5 data set
 
     Load HDF5 objects from a dataset, passing the name of the file as a parameter
+
+    If lazy is True, datasets are not read: they are loaded as LazyDataset handles that read
+    on access, and lists saved by columns as LazyList (see hdf5_open). The file must stay open
+    while the loaded objects are used.
     """
     # Open the file object
     close_file = False
@@ -153,21 +427,28 @@ def hdf5_load_object(file, group=None):
         group = file['/']
 
     # Attempt to find the class name or data value (if class name not present)
-    if not '__class__' in group.attrs and 'data' in group:
+    if '__columnar__' in group.attrs:
+        x = LazyList(file, group) if lazy else _hdf5_load_columns(file, group)
+    elif not '__class__' in group.attrs and 'data' in group:
         # No class, just load the dataset under data
+        if lazy:
+            return LazyDataset(group['data'], file, group)
         return _hdf5_load_dataset(group['data'], file, group)
     elif '__class__' in group.attrs:
         c = pickle.loads(group.attrs['__class__'])
+        handler = _hdf5_type_handler(c)
+        if handler is not None and handler[1] is not None:
+            return handler[1](file, group)
         x = c.__new__(c)
         if '__hdf5_load__' in dir(x):
             return x.__hdf5_load__(file, group)
-        _hdf5_load_group(x, file, group)
+        _hdf5_load_group(x, file, group, lazy)
         if '__hdf5_post_load__' in dir(x):
             x.__hdf5_post_load__()
     elif isinstance(group, h5.Group):
         # no class and no data, just load the top object
         loaded_group = type('h5class', (), {})()
-        _hdf5_load_group(loaded_group, file, group)
+        _hdf5_load_group(loaded_group, file, group, lazy)
         return loaded_group.__dict__  # NOTE: Added this 03/03/2017 (returns a dict instead of an opaque class)
     else:
         raise RuntimeError('Invalid HDF5 file')
@@ -178,17 +459,20 @@ def hdf5_load_object(file, group=None):
     return x  # Return the loaded array
 
 
-def _hdf5_load_group(x, file, group):
+def _hdf5_load_group(x, file, group, lazy=False):
     # Look at all data sets and load those
     for key in group:
         if len(key) >= 2 and key[:2] == '__':
             continue  # Skip hidden keys
         value = group[key]
         if isinstance(value, h5.Dataset):
-            dataset = _hdf5_load_dataset(value, file, group)
+            if lazy:
+                dataset = LazyDataset(value, file, group)
+            else:
+                dataset = _hdf5_load_dataset(value, file, group)
             setattr(x, key, dataset)
         elif isinstance(value, h5.Group):
-            value = hdf5_load_object(file, value) # Load the new group (value = group)
+            value = hdf5_load_object(file, value, lazy) # Load the new group (value = group)
             setattr(x, key, value) #  Note that value is an object here
     for key in group.attrs:
         if len(key) >= 2 and key[:2] == '__':
@@ -202,8 +486,47 @@ def _hdf5_load_group(x, file, group):
             setattr(x, key, value)
 
 
-def _hdf5_load_dataset(dataset, file, group):
-    value = dataset.value
+def _hdf5_load_columns(file, group):
+    """Loads a list saved by _hdf5_save_columns"""
+    kind = group.attrs['__columnar__']
+    length = int(group.attrs['__length__'])
+    if kind == 'ragged':
+        values = group['values'][()]
+        offsets = group['offsets'][()]
+        return [values[offsets[i]:offsets[i + 1]] for i in range(length)]
+    if kind == 'lists':
+        values = hdf5_load_object(file, group['values'])
+        offsets = group['offsets'][()]
+        return [values[offsets[i]:offsets[i + 1]] for i in range(length)]
+    fields = [str(field) for field in group.attrs['__fields__']]
+    columns = {}
+    for field in fields:
+        if field in group.attrs:
+            columns[field] = [None] * length
+        elif isinstance(group[field], h5.Group):
+            columns[field] = hdf5_load_object(file, group[field])
+        elif h5.check_string_dtype(group[field].dtype) is not None:
+            columns[field] = list(group[field].asstr()[()])
+        elif h5.check_ref_dtype(group[field].dtype) is not None:
+            columns[field] = _hdf5_load_dataset(group[field], file, group)
+        else:
+            columns[field] = group[field][()]
+    if kind == 'dicts':
+        return [{field: columns[field][i] for field in fields} for i in range(length)]
+    c = pickle.loads(group.attrs['__class__'])
+    x = []
+    for i in range(length):
+        y = c.__new__(c)
+        for field in fields:
+            setattr(y, field, columns[field][i])
+        if '__hdf5_post_load__' in dir(y):
+            y.__hdf5_post_load__()
+        x.append(y)
+    return x
+
+
+def _hdf5_load_dataset(dataset, file, group, lazy=False):
+    value = dataset[()]
     if isinstance(value, np.ndarray):
         value = np.atleast_1d(np.squeeze(value))
         if len(value.shape) == 0:
@@ -211,13 +534,181 @@ def _hdf5_load_dataset(dataset, file, group):
         for i in range(len(value)):
             if isinstance(value[i], h5.Reference):  # Load any references
                 new_group = group[value[i]]
-                value[i] = hdf5_load_object(file, new_group)
+                value[i] = hdf5_load_object(file, new_group, lazy)
             else:
                 value = np.squeeze(value)
                 break  # This is a standard array (no support for incomplete referencing)
     return value
 
 
+class LazyDataset():
+    """Deferred handle of an HDF5 dataset (see hdf5_open)
+
+    Nothing is read when the object holding the handle is loaded. Indexing reads only the
+    requested part of the dataset and read() (or np.asarray) reads, and caches, the value of
+    the eager loader: singleton dimensions are squeezed and references are loaded as objects
+    (lazily, only the referenced elements that are indexed).
+    """
+    def __init__(self, dataset, file, group):
+        self.dataset = dataset
+        self.file = file
+        self.group = group
+        self._value = None
+        self._references = None
+        # Axes of the dataset that remain after squeezing
+        self._axes = [i for i, n in enumerate(dataset.shape or ()) if n != 1]
+        self._is_reference = h5.check_ref_dtype(dataset.dtype) is not None
+        self._sliceable = dataset.size > 0 and not self._is_reference and \
+            h5.check_string_dtype(dataset.dtype) is None
+
+    @property
+    def shape(self):
+        if self._sliceable:
+            return tuple(self.dataset.shape[i] for i in self._axes)
+        return np.shape(self.read())
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return '<LazyDataset {:s} shape={} dtype={}>'.format(self.dataset.name, self.shape, self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        value = np.asarray(self.read())
+        return value if dtype is None else value.astype(dtype)
+
+    def read(self):
+        """Reads (once) and returns the whole value"""
+        if self._value is None:
+            self._value = _hdf5_load_dataset(self.dataset, self.file, self.group, lazy=True)
+        return self._value
+
+    def __getitem__(self, key):
+        if self._value is not None:
+            return self._value[key]
+        if self._is_reference:
+            if self._references is None:
+                self._references = np.atleast_1d(np.squeeze(self.dataset[()]))
+            references = self._references[key]
+            if isinstance(references, h5.Reference):
+                return hdf5_load_object(self.file, self.group[references], lazy=True)
+            value = np.empty(references.shape, dtype=object)
+            for index in np.ndindex(references.shape):
+                value[index] = hdf5_load_object(self.file, self.group[references[index]], lazy=True)
+            return value
+        if not self._sliceable:
+            return self.read()[key]
+        # Index the squeezed axes of the dataset
+        if not isinstance(key, tuple):
+            key = (key,)
+        if not all(k is Ellipsis or isinstance(k, slice) or isinstance(k, (int, np.integer)) for k in key) or \
+                sum(k is Ellipsis for k in key) > 1:
+            return self.read()[key] # Fancy indexing, read everything
+        if Ellipsis in key:
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (len(self._axes) - len(key) + 1) + key[i + 1:]
+        if len(key) > len(self._axes):
+            raise IndexError('Too many indices for a dataset of shape {}'.format(self.shape))
+        full_key = [0] * len(self.dataset.shape)
+        for axis, k in zip(self._axes, key + (slice(None),) * (len(self._axes) - len(key))):
+            full_key[axis] = k
+        try:
+            return self.dataset[tuple(full_key)]
+        except (TypeError, ValueError): # Selections not supported by HDF5 (e.g. negative steps)
+            return self.read()[key]
+
+
+class LazyList():
+    """List saved by columns (see _hdf5_save_columns) whose elements are only read when accessed"""
+    def __init__(self, file, group):
+        self.file = file
+        self.group = group
+        self.kind = group.attrs['__columnar__']
+        self._length = int(group.attrs['__length__'])
+        if self.kind == 'ragged' or self.kind == 'lists':
+            self._offsets = group['offsets'][()]
+        if self.kind == 'lists':
+            self._values = hdf5_load_object(file, group['values'], lazy=True)
+        if self.kind == 'objects' or self.kind == 'dicts':
+            self.fields = [str(field) for field in group.attrs['__fields__']]
+            self._columns = [self._column(field) for field in self.fields]
+        if self.kind == 'objects':
+            self._class = pickle.loads(group.attrs['__class__'])
+
+    def _column(self, field):
+        """Returns a function reading the value of field of element i"""
+        if field in self.group.attrs:
+            return lambda i: None
+        item = self.group[field]
+        if isinstance(item, h5.Group):
+            return hdf5_load_object(self.file, item, lazy=True).__getitem__
+        if h5.check_string_dtype(item.dtype) is not None:
+            return lambda i: item.asstr()[i]
+        if h5.check_ref_dtype(item.dtype) is not None:
+            return LazyDataset(item, self.file, self.group).__getitem__
+        return item.__getitem__
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield self[i]
+
+    def __repr__(self):
+        return '<LazyList {:s} of {:d} {:s}>'.format(self.group.name, self._length, self.kind)
+
+    def read(self):
+        """Reads all the elements"""
+        return _hdf5_load_columns(self.file, self.group)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        index = operator.index(index)
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError('Index {:d} out of range'.format(index))
+        if self.kind == 'ragged':
+            return self.group['values'][self._offsets[index]:self._offsets[index + 1]]
+        if self.kind == 'lists':
+            return self._values[self._offsets[index]:self._offsets[index + 1]]
+        if self.kind == 'dicts':
+            return {field: column(index) for field, column in zip(self.fields, self._columns)}
+        y = self._class.__new__(self._class)
+        for field, column in zip(self.fields, self._columns):
+            setattr(y, field, column(index))
+        if '__hdf5_post_load__' in dir(y):
+            y.__hdf5_post_load__()
+        return y
+
+
+@contextmanager
+def hdf5_open(filename):
+    """Opens an HDF5 file and lazily loads its contents (see hdf5_load_object)
+
+    with hdf5_open(filename) as data:
+        spikes = data['units'][3].spikes[:1000]  # Only reads what is accessed
+    The lazily loaded values can only be read inside the with block.
+    """
+    if not os.path.isfile(filename):
+        raise RuntimeError('Path to {:s} is invalid.'.format(filename))
+    file = h5.File(filename, "r", libver='latest')
+    try:
+        yield hdf5_load_object(file, lazy=True)
+    finally:
+        file.close()
+
+
 def hdf5_load(filename):
     """ Loads an HDF5 into numpy elements
     :param filename: Name of the HDF5 file to open
@@ -228,12 +719,401 @@ def hdf5_load(filename):
         raise RuntimeError('Path to {:s} is invalid.'.format(filename))
     return hdf5_load_object(filename)
 
-def hdf5_append_dataset(filename, name, data):
+def hdf5_append_dataset(filename, name, data, policy=None):
+    """Appends data (along its first axis) to the dataset name of an existing HDF5 file
+    The dataset is created (resizable) if it does not exist yet, see hdf5_extend. To append many
+    times to the same file, use an HDF5AppendWriter which keeps the file open and batches the writes.
+    """
     if not os.path.isfile(filename):
         raise RuntimeError('Path to {:s} is invalid.'.format(filename))
-    f = h5.File(filename, "r+")
-    if name in f:
-        del f[name]
-    dset = f.create_dataset(name, data=data)
-    f.close()
-    
+    with h5.File(filename, "r+") as f:
+        hdf5_extend(f, name, data, policy)
+
+def hdf5_extend(group, name, rows, policy=None):
+    """Appends rows (along the first axis) to the resizable dataset name of group
+
+    :param group: An open HDF5 file or group
+    :param name: Path of the dataset relative to group (intermediate groups are created)
+    :param rows: Array whose first axis is appended, the other axes must match the dataset
+    :param policy: StoragePolicy used to chunk and compress a new dataset (default: uncompressed
+    chunks, see STORAGE_POLICIES['chunked'])
+    :return: The dataset
+    A dataset that is not resizable (e.g. written by hdf5_save_object) is rewritten once as a
+    resizable dataset, use hdf5_compact to reclaim the space of the old copy.
+    """
+    rows = np.asarray(rows)
+    if rows.ndim == 0:
+        rows = rows[np.newaxis]
+    if policy is None:
+        policy = STORAGE_POLICIES['chunked']
+    if name not in group:
+        return group.create_dataset(name, data=rows, **policy.resizable_options(rows))
+    dataset = group[name]
+    if dataset.shape[1:] != rows.shape[1:]:
+        raise ValueError('Cannot append rows of shape {} to {} of shape {}'.format(
+            rows.shape, dataset.name, dataset.shape))
+    if dataset.maxshape[0] is not None:
+        old = dataset[()]
+        del group[name]
+        return group.create_dataset(name, data=np.concatenate((old, rows), axis=0),
+                                    **policy.resizable_options(old))
+    n = dataset.shape[0]
+    dataset.resize(n + rows.shape[0], axis=0)
+    dataset[n:] = rows
+    return dataset
+
+class HDF5AppendWriter():
+    """ Streams rows into resizable datasets of an HDF5 file
+
+    The appended rows are kept in memory until buffer_size bytes are buffered, then each dataset
+    is extended once with all of its buffered rows. This keeps the number of (slow) resize and
+    write calls small when results arrive in many small pieces, e.g. one per sorted file:
+        with HDF5AppendWriter('cohort.h5') as writer:
+            for results in ...:
+                writer.extend('spike_indices', results['spike_indices'])
+                writer.append('signal_size', results['signal_size'])
+    """
+    def __init__(self, filename, mode='a', buffer_size=1 << 24, policy=None):
+        """
+        Object constructor
+        :param mode: HDF5 file mode ('a': append to an existing file or create it, 'w': truncate)
+        :param buffer_size: Number of buffered bytes that triggers a flush
+        :param policy: StoragePolicy of the new datasets (see hdf5_extend)
+        """
+        self.file = h5.File(filename, mode, libver='latest')
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self._buffers = {}  # name -> list of arrays
+        self._buffered = 0
+
+    def extend(self, name, rows):
+        """Appends rows (along their first axis) to the dataset name"""
+        rows = np.array(rows, ndmin=1)  # Copy, the caller may reuse its array
+        buffered = self._buffers.setdefault(name, [])
+        if len(buffered) > 0 and buffered[0].shape[1:] != rows.shape[1:]:
+            raise ValueError('Cannot append rows of shape {} to {} (rows of shape {})'.format(
+                rows.shape, name, buffered[0].shape[1:]))
+        buffered.append(rows)
+        self._buffered += rows.nbytes
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def append(self, name, row):
+        """Appends a single row to the dataset name"""
+        self.extend(name, np.asarray(row)[np.newaxis])
+
+    def flush(self):
+        """Writes the buffered rows to the file"""
+        for name in self._buffers:
+            hdf5_extend(self.file, name, np.concatenate(self._buffers[name], axis=0), self.policy)
+        self._buffers = {}
+        self._buffered = 0
+        self.file.flush()
+
+    def close(self):
+        """Flushes the buffered rows and closes the file"""
+        if self.file.id.valid:
+            try:
+                self.flush()
+            finally:
+                self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def hdf5_compact(filename, output=None):
+    """Rewrites an HDF5 file without the space left by deleted or rewritten datasets
+
+    HDF5 does not reuse the space of deleted objects, so files that were modified many times
+    (e.g. with hdf5_extend) keep growing. The objects are copied (with their chunking,
+    compression and attributes) into a new file.
+    :param output: Name of the compacted file. If None, filename is replaced.
+    :return: The size of the compacted file (bytes)
+    """
+    if not os.path.isfile(filename):
+        raise RuntimeError('Path to {:s} is invalid.'.format(filename))
+    target = filename + '.compact' if output is None else output
+    with h5.File(filename, 'r') as source, h5.File(target, 'w', libver='latest') as destination:
+        for key in source.attrs:
+            destination.attrs[key] = source.attrs[key]
+        for key in source:
+            source.copy(source[key], destination, name=key)
+
+        # Object references are only translated within a single copy, point them to the copies
+        def relink(name, item):
+            if isinstance(item, h5.Dataset) and h5.check_ref_dtype(item.dtype) is h5.Reference:
+                refs = source[name][()]
+                item[...] = np.array([destination[source[ref].name].ref if ref else ref for ref in refs.flat],
+                                     dtype=item.dtype).reshape(refs.shape)
+        destination.visititems(relink)
+    if output is None:
+        os.replace(target, filename)
+    return os.path.getsize(filename if output is None else output)
+
+class HDF5AggregatorClient():
+    """ Picklable handle that workers use to send arrays to an HDF5Aggregator"""
+    def __init__(self, queue, stopped):
+        """
+        Object constructor
+        :param stopped: Event set when the writer process is no longer running
+        """
+        self.queue = queue
+        self.stopped = stopped
+
+    def add(self, record):
+        """Appends each array of the dictionary record (name -> rows) to the dataset of that name
+
+        The arrays of a record are sent as a single message and written together, so datasets
+        that are extended by every record stay aligned (e.g. {'unit': [k] * n, 'times': times}).
+        Raises a RuntimeError if the writer process has stopped.
+        """
+        _put(self.queue, {name: np.asarray(record[name]) for name in record}, self.stopped.is_set)
+
+    def extend(self, name, rows):
+        """Appends rows (along their first axis) to the dataset name"""
+        self.add({name: rows})
+
+    def append(self, name, row):
+        """Appends a single row to the dataset name"""
+        self.add({name: np.asarray(row)[np.newaxis]})
+
+class HDF5Aggregator():
+    """ Collects the arrays sent by many worker processes into a single HDF5 file
+
+    HDF5 files cannot be written by several processes at once. The aggregator runs a single
+    writer process that receives the arrays of the workers over a queue and appends them to
+    resizable datasets (see HDF5AppendWriter, the writes are batched). The workers only hold the
+    picklable client, which can be passed to joblib or multiprocessing workers:
+        with HDF5Aggregator('cohort.h5') as aggregator:
+            Parallel(n_jobs=8)(delayed(process)(arg, aggregator.client) for arg in inputs)
+    Errors of the writer are raised by start (e.g. the file cannot be opened) and stop (a write
+    failed). Workers sending to a writer that stopped get a RuntimeError instead of blocking.
+    Alternatively, each worker writes its own file and hdf5_virtual_concatenate joins them.
+    """
+    def __init__(self, filename, mode='a', buffer_size=1 << 24, policy=None, queue_size=64):
+        """
+        Object constructor
+        :param mode: HDF5 file mode of the output ('a': append to an existing file or create it, 'w': truncate)
+        :param buffer_size: Number of bytes buffered by the writer before writing (see HDF5AppendWriter)
+        :param policy: StoragePolicy of the new datasets (see hdf5_extend)
+        :param queue_size: Maximum number of pending messages, workers block when the writer falls behind
+        """
+        self.filename = filename
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.queue_size = queue_size
+        self.client = None
+        self._manager = None
+        self._process = None
+        self._watcher = None
+        self._status = None
+
+    def start(self):
+        """Starts the writer process, returns once the output file is open"""
+        self._manager = multiprocessing.Manager()
+        self._status = self._manager.Queue()
+        self.client = HDF5AggregatorClient(self._manager.Queue(self.queue_size), self._manager.Event())
+        self._process = multiprocessing.Process(target=_hdf5_aggregate, daemon=True,
+                                                args=(self.client.queue, self._status, self.filename,
+                                                      self.mode, self.buffer_size, self.policy))
+        self._process.start()
+        # Flag the end of the writer, however it ends, so that the clients stop waiting for it
+        self._watcher = threading.Thread(target=_hdf5_watch, args=(self._process, self.client.stopped), daemon=True)
+        self._watcher.start()
+        status = self._wait_status()
+        if status != 'ready':
+            self._process.join()
+            self._watcher.join()
+            self._manager.shutdown()
+            self._raise(status)
+        return self
+
+    def stop(self):
+        """Writes the outstanding arrays, closes the file and stops the writer process"""
+        try:
+            _put(self.client.queue, None, lambda: not self._process.is_alive())  # Sentinel for the writer
+        except RuntimeError:
+            pass  # The writer already stopped, its status tells why
+        self._process.join()
+        self._watcher.join()
+        status = self._wait_status()
+        self._manager.shutdown()
+        if status != 'done':
+            self._raise(status)
+
+    def _wait_status(self):
+        while True:
+            try:
+                return self._status.get(timeout=_AGGREGATOR_POLL_INTERVAL)
+            except Empty:
+                if not self._process.is_alive() and self._status.empty():
+                    return ('error', None)
+
+    def _raise(self, status):
+        error = status[1]
+        if error is None:
+            raise RuntimeError('The writer of {:s} stopped (exit code {})'.format(self.filename, self._process.exitcode))
+        raise RuntimeError('Writing {:s} failed: {!r}'.format(self.filename, error)) from error
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+# Seconds between the checks that the writer process is still running
+_AGGREGATOR_POLL_INTERVAL = 0.5
+
+def _put(queue, message, stopped):
+    """Puts message on the bounded queue, raising a RuntimeError once stopped() is True"""
+    while True:
+        try:
+            queue.put(message, timeout=_AGGREGATOR_POLL_INTERVAL)
+            return
+        except Full:
+            if stopped():
+                raise RuntimeError('The HDF5 writer process is not running')
+
+def _hdf5_watch(process, stopped):
+    process.join()
+    stopped.set()
+
+def _hdf5_aggregate(queue, status, filename, mode, buffer_size, policy):
+    try:
+        writer = HDF5AppendWriter(filename, mode, buffer_size, policy)
+    except Exception as e:
+        status.put(('error', _picklable(e)))
+        return
+    status.put('ready')
+    error = None
+    try:
+        while True:
+            message = queue.get()
+            if message is None:
+                break
+            if error is not None:
+                continue  # Keep draining the queue so that the workers do not block
+            try:
+                for name in message:
+                    writer.extend(name, message[name])
+            except Exception as e:
+                error = e
+    finally:
+        try:
+            writer.close()
+        except Exception as e:
+            error = e if error is None else error
+    status.put('done' if error is None else ('error', _picklable(error)))
+
+def _picklable(error):
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(repr(error))
+
+def hdf5_virtual_concatenate(filenames, output, names=None):
+    """Joins the datasets of several HDF5 files into virtual datasets (without copying the data)
+
+    Each dataset of output concatenates, along the first axis, the datasets of the same name in
+    filenames (e.g. per-worker files written with HDF5AppendWriter). Files without the dataset
+    are skipped. The source files are referenced relative to the output file and must stay in place.
+    :param names: Datasets to join (default: all the datasets of the first file)
+    """
+    if names is None:
+        names = []
+        with h5.File(filenames[0], 'r') as f:
+            f.visititems(lambda name, item: names.append(name) if isinstance(item, h5.Dataset) else None)
+    directory = os.path.dirname(os.path.abspath(output))
+    with h5.File(output, 'w', libver='latest') as out:
+        for name in names:
+            sources = []
+            for filename in filenames:
+                with h5.File(filename, 'r') as f:
+                    if name in f:
+                        sources.append((os.path.relpath(os.path.abspath(filename), directory),
+                                        f[name].shape, f[name].dtype))
+            if len(sources) == 0:
+                continue
+            row, dtype = sources[0][1][1:], sources[0][2]
+            if any(shape[1:] != row for _, shape, _ in sources):
+                raise ValueError('The rows of {} have different shapes in {}'.format(name, filenames))
+            layout = h5.VirtualLayout(shape=(sum(shape[0] for _, shape, _ in sources),) + row, dtype=dtype)
+            position = 0
+            for filename, shape, _ in sources:
+                if shape[0] > 0:
+                    layout[position:position + shape[0]] = h5.VirtualSource(filename, name, shape=shape)
+                position += shape[0]
+            out.create_virtual_dataset(name, layout)
+
+
+def hdf5_benchmark_policies(policies=None, directory=None, duration=60.0, fs=25000.0, repeats=3):
+    """Compares the storage policies on arrays shaped like our recordings
+
+    Writes a raw int16 voltage trace, the filtered float64 trace and float32 spike waveforms with
+    each policy and reports the write time, the time to read everything, the time to read 100 ms
+    time ranges and the file size.
+    :param policies: Dictionary of name -> StoragePolicy (or None), defaults to STORAGE_POLICIES
+    :param directory: Where the test files are written (defaults to the temporary directory)
+    :param duration: Length of the synthetic recording (s)
+    :param fs: Sampling rate (Hz)
+    :return: Dictionary of name -> {'write', 'read', 'range_read' (s), 'size' (bytes)}
+    """
+    import tempfile
+    import time
+    if policies is None:
+        policies = STORAGE_POLICIES
+    if directory is None:
+        directory = tempfile.gettempdir()
+    rng = np.random.default_rng(0)
+    n = int(duration * fs)
+    # Band limited noise with sparse spikes, quantized like the ADC output
+    noise = np.cumsum(rng.standard_normal(n)) * 0.05
+    noise -= np.convolve(noise, np.ones(101) / 101, mode='same')
+    noise += rng.standard_normal(n) * 0.5
+    times = rng.integers(0, n - 60, size=int(duration * 50))
+    for t in times:
+        noise[t:t + 20] -= 8 * np.hanning(20)
+    data = {'voltage': np.round(noise * 400).astype(np.int16),
+            'filtered': noise,
+            'waveforms': np.stack([noise[t:t + 60] for t in times]).astype(np.float32)}
+    range_length = int(0.1 * fs)
+    starts = rng.integers(0, n - range_length, size=100)
+    results = {}
+    for label in policies:
+        filename = os.path.join(directory, 'hdf5_benchmark_{}.h5'.format(label))
+        write = read = range_read = np.inf
+        for _ in range(repeats):
+            start = time.perf_counter()
+            hdf5_save_object(data, filename, name='recording', policy=policies[label])
+            write = min(write, time.perf_counter() - start)
+            start = time.perf_counter()
+            with h5.File(filename, 'r') as f:
+                for key in data:
+                    f['recording'][key][()]
+            read = min(read, time.perf_counter() - start)
+            start = time.perf_counter()
+            with h5.File(filename, 'r') as f:
+                for key in ('voltage', 'filtered'):
+                    dataset = f['recording'][key]
+                    for s in starts:
+                        dataset[s:s + range_length]
+            range_read = min(range_read, time.perf_counter() - start)
+        results[label] = {'write': write, 'read': read, 'range_read': range_read,
+                          'size': os.path.getsize(filename)}
+        os.remove(filename)
+    return results
+
+
+if __name__ == '__main__':
+    total = None
+    for label, result in hdf5_benchmark_policies().items():
+        if total is None:
+            total = result['size']
+        print('{:>10s}: write {:6.3f}s, read {:6.3f}s, 200 range reads {:6.3f}s, size {:6.1f} MB ({:3.0f}%)'.format(
+            label, result['write'], result['read'], result['range_read'], result['size'] / 1e6,
+            100.0 * result['size'] / total))
@@ -4,6 +4,9 @@ Copyright (c) 2016 David Herzfeld
 Written by David J. Herzfeld <herzfeldd@gmail.com>
 """
 
+import collections.abc
+import json
+import os
 import numpy as np
 import pickle
 import h5py
@@ -13,10 +16,13 @@ import scipy.stats
 def sem(x, axis=0):
     """Returns the standard error about the mean for a particular axis
 
-    :param x The input matrix or vector (numpy)
+    :param x The input matrix or vector (numpy), or an iterator of chunks of it (concatenated
+    along axis) that is accumulated with RunningStats
     :param axis The axis to use to compute the standard error (0 is default)
     :return The standard error along the particular dimension
     """
+    if _is_stream(x):
+        return RunningStats(axis).update_all(x).sem()
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
         y = np.nanstd(x, axis) / np.sqrt(np.sum(~np.isnan(x), axis))
@@ -25,13 +31,82 @@ def sem(x, axis=0):
 def ci(x, axis=0):
     """Returns the 95% confidence intervals about the mean for a particular axis
 
-    :param x The input matrix or vector (numpy)
+    :param x The input matrix or vector (numpy), or an iterator of chunks of it (see sem)
     :param axis The axis to use to compute the 95% confidence intervals (0 is default)
     :return The 95% confidence intervals along the particular dimension
     """
+    if _is_stream(x):
+        return RunningStats(axis).update_all(x).ci()
 
     return np.abs(scipy.stats.t.interval(0.95, np.array(x).shape[axis]-1, scale=sem(x, axis))[0])
 
+class RunningStats():
+    """ Streaming mean and variance, ignoring NaNs like np.nanmean and np.nanstd
+
+    The data are passed in chunks along axis. Each chunk is summarized by its counts, means and
+    sums of squared deviations, which are merged into the running values (the parallel form of
+    Welford's algorithm, Chan et al. 1979), so the result does not depend on the chunking.
+    """
+    def __init__(self, axis=0):
+        """
+        Object constructor
+        """
+        self.axis = axis
+        self.rows = 0  # Number of samples along axis (including NaNs)
+        self.count = None  # Number of (not NaN) samples
+        self.mean = None
+        self._m2 = None
+
+    def update(self, x):
+        """Adds a chunk of data"""
+        x = np.moveaxis(np.asarray(x, dtype=np.float64), self.axis, 0)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            count = np.sum(~np.isnan(x), axis=0)
+            mean = np.nan_to_num(np.nanmean(x, axis=0))
+            m2 = np.nansum((x - mean) ** 2, axis=0)
+        self.rows = self.rows + x.shape[0]
+        if self.count is None:
+            self.count, self.mean, self._m2 = count, mean, m2
+            return self
+        total = self.count + count
+        delta = mean - self.mean
+        weight = count / np.maximum(total, 1)
+        self.mean = self.mean + delta * weight
+        self._m2 = self._m2 + m2 + delta ** 2 * self.count * weight
+        self.count = total
+        return self
+
+    def update_all(self, chunks):
+        """Adds all the chunks of an iterator (or of the iterator returned by the function chunks)"""
+        for chunk in (chunks() if callable(chunks) else chunks):
+            self.update(chunk)
+        return self
+
+    def var(self, ddof=0):
+        """Returns the variance (NaN where fewer than ddof + 1 samples were seen)"""
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            return np.where(self.count > ddof, self._m2, np.nan) / (self.count - ddof)
+
+    def std(self, ddof=0):
+        """Returns the standard deviation"""
+        return np.sqrt(self.var(ddof))
+
+    def sem(self):
+        """Returns the standard error about the mean (see sem)"""
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            return self.std() / np.sqrt(self.count)
+
+    def ci(self):
+        """Returns the 95% confidence intervals about the mean (see ci)"""
+        return np.abs(scipy.stats.t.interval(0.95, self.rows - 1, scale=self.sem())[0])
+
+def _is_stream(x):
+    """True if x is an iterator of chunks or a function returning one"""
+    return isinstance(x, collections.abc.Iterator) or callable(x)
+
 def angle_mod(theta, phi):
     """Determines the minimum angular distance between theta and phi
 
@@ -54,8 +129,27 @@ def angle_mod(theta, phi):
     x[x > np.pi] = x[x > np.pi] - 2 * np.pi
     return x
 
-def pca(x):
-    """Performs principle component analysis on the input matrix, x"""
+def pca(x, n_components=None, method='eig', chunk_size=1 << 16, dtype=np.float32, n_iter=4, random_state=None):
+    """Performs principle component analysis on the input matrix, x
+
+    With the default arguments, the covariance of the centered matrix is decomposed with eig. The
+    other methods accumulate the covariance (or its products) chunk by chunk without centering a
+    copy of x, so x can also be streamed.
+    :param x: A (samples x features) matrix, an iterator of chunks of its rows, or a function
+    returning such an iterator. The data of a function are read again to compute the scores (and
+    for each randomized iteration), the score of an iterator is None.
+    :param n_components: Number of components returned (default all)
+    :param method: 'eig', 'eigh' (symmetric eigen decomposition of the accumulated covariance), or
+    'randomized' (randomized subspace iteration, for n_components much smaller than the number of
+    features; needs a matrix or a function, every iteration reads the data once)
+    :param chunk_size: Number of rows per chunk when x is a matrix
+    :param dtype: Type of the chunk products and of the scores (the sums are accumulated in float64)
+    :param n_iter: Number of randomized subspace iterations
+    :param random_state: Seed of the randomized method
+    :return: coeff, score, latent, percent_explained
+    """
+    if method != 'eig' or n_components is not None or _is_stream(x):
+        return _streaming_pca(x, n_components, method, chunk_size, dtype, n_iter, random_state)
     x = x - np.mean(x, axis=0)
     [latent, coeff] = np.linalg.eig(np.cov(x.T))
     # Convert to real
@@ -74,6 +168,86 @@ def pca(x):
     percent_explained = latent * 100 / np.sum(latent)
     return coeff, score, latent, percent_explained
 
+def _streaming_pca(x, n_components, method, chunk_size, dtype, n_iter, random_state):
+    if method not in ('eig', 'eigh', 'randomized'):
+        raise ValueError('Unknown PCA method {}'.format(method))
+    if isinstance(x, collections.abc.Iterator):
+        if method == 'randomized':
+            raise ValueError('The randomized PCA reads the data several times, pass a function returning the chunks')
+        chunks, reusable = (lambda: x), False
+    elif callable(x):
+        chunks, reusable = x, True
+    else:
+        x = np.asarray(x)
+        chunks, reusable = (lambda: (x[i:i + chunk_size] for i in range(0, x.shape[0], chunk_size))), True
+
+    def read(chunk):
+        # The data are shifted by the mean of the first chunk, which avoids the cancellation
+        # of the (float32) sums of products of uncentered data
+        return np.asarray(chunk, dtype=dtype) - shift
+
+    def covariance_product(q):
+        # (x - mean)' * (x - mean) * q / (n - 1), without centering x
+        product = 0
+        for chunk in chunks():
+            chunk = read(chunk)
+            product = product + np.dot(chunk.T, np.dot(chunk, q.astype(dtype)))
+        return (product - n * np.outer(mean, np.dot(mean, q))) / (n - 1)
+
+    # First pass: sums (and the products with a random basis for the randomized method)
+    n = 0
+    total = sum_squares = gram = y = None
+    for chunk in chunks():
+        if total is None:
+            shift = np.mean(np.asarray(chunk, dtype=np.float64), axis=0).astype(dtype)
+        chunk = read(chunk)
+        if total is None:
+            features = chunk.shape[1]
+            total, sum_squares = np.zeros(features), np.zeros(features)
+            if method == 'randomized':
+                k = features if n_components is None else min(n_components, features)
+                omega = np.random.default_rng(random_state).standard_normal((features, min(features, k + 10)))
+                y = 0
+            else:
+                gram = np.zeros((features, features))
+        n = n + chunk.shape[0]
+        total = total + np.sum(chunk, axis=0, dtype=np.float64)
+        sum_squares = sum_squares + np.einsum('ij,ij->j', chunk, chunk, dtype=np.float64)
+        if gram is not None:
+            gram = gram + np.dot(chunk.T, chunk)
+        else:
+            y = y + np.dot(chunk.T, np.dot(chunk, omega.astype(dtype)))
+    if n < 2:
+        raise ValueError('PCA needs at least two samples')
+    mean = total / n
+    total_variance = np.sum(sum_squares - n * mean ** 2) / (n - 1)
+
+    if method == 'randomized':
+        q = np.linalg.qr((y - n * np.outer(mean, np.dot(mean, omega))) / (n - 1))[0]
+        for i in range(n_iter):
+            q = np.linalg.qr(covariance_product(q))[0]
+        latent, vectors = np.linalg.eigh(np.dot(q.T, covariance_product(q)))
+        coeff = np.dot(q, vectors)
+    else:
+        covariance = (gram - n * np.outer(mean, mean)) / (n - 1)
+        if method == 'eig':
+            latent, coeff = np.linalg.eig(covariance)
+            latent, coeff = np.real(latent), np.real(coeff)
+        else:
+            latent, coeff = np.linalg.eigh(covariance)
+    # Sort everything by the percent of the variance that was explained
+    index = np.flipud(np.argsort(latent))[:n_components]
+    latent = latent[index]
+    coeff = coeff[:, index]
+    percent_explained = latent * 100 / total_variance
+
+    score = None
+    if reusable:
+        offset = np.dot(mean, coeff).astype(dtype)
+        projection = coeff.astype(dtype)
+        score = np.concatenate([np.dot(read(chunk), projection) - offset for chunk in chunks()])
+    return coeff, score, latent, percent_explained
+
 
 def select(x, mask):
     """Returns a subset of the list, x, selected by the mask
@@ -97,33 +271,86 @@ def find_first(x, start=None, direction='forward', inclusive=True, pattern=[True
     """Finds the first true value in the sequence
 
     Returns the index of the first True value in the sequence (assuming a binary
-    array, x.
+    array, x. Searching backwards returns the index of the last element of the
+    pattern. The sequence is scanned in blocks of growing size, so a match close
+    to start is found without comparing the whole sequence.
     :param x: A binary (numpy) array
     :param start: The index to start looking [0, len(x) - 1]. Default is None
     :param direction: Forward or backwards (the direction of the search)
     :param inclusive: Include the start index in the search (defaults to True)
     :param pattern: The pattern to find, default to true (i.e. the first true)
     """
+    x, pattern, first, last, forward = _find_range(x, start, direction, inclusive, pattern)
+    block = _FIND_BLOCK_SIZE
+    if forward:
+        while first < last:
+            end = min(first + block, last)
+            index = np.flatnonzero(_find_matches(x, pattern, first, end))
+            if len(index) > 0:
+                return int(first + index[0])
+            first = end
+            block = min(2 * block, _FIND_MAX_BLOCK_SIZE)
+    else:
+        while first > last:
+            begin = max(first - block, last)
+            index = np.flatnonzero(_find_matches(x, pattern, begin + 1, first + 1))
+            if len(index) > 0:
+                return int(begin + 1 + index[-1] + len(pattern) - 1)
+            first = begin
+            block = min(2 * block, _FIND_MAX_BLOCK_SIZE)
+    return None  # Not found
+
+def find_all(x, start=None, direction='forward', inclusive=True, pattern=[True]):
+    """Finds all the occurrences of a pattern in the sequence
+
+    Returns the indices of all the (possibly overlapping) matches of pattern, in the
+    order in which find_first would find them, i.e. find_all(...)[0] == find_first(...).
+    :param x: A binary (numpy) array
+    :param start: The index to start looking [0, len(x) - 1]. Default is None
+    :param direction: Forward or backwards (the direction of the search)
+    :param inclusive: Include the start index in the search (defaults to True)
+    :param pattern: The pattern to find, default to true (i.e. all the true values)
+    :return: A numpy array of indices (the last element of each match when searching backwards)
+    """
+    x, pattern, first, last, forward = _find_range(x, start, direction, inclusive, pattern)
+    if forward:
+        if first >= last:
+            return np.zeros(0, dtype=np.int64)
+        return first + np.flatnonzero(_find_matches(x, pattern, first, last))
+    if first <= last:
+        return np.zeros(0, dtype=np.int64)
+    index = np.flatnonzero(_find_matches(x, pattern, last + 1, first + 1))
+    return (last + 1 + len(pattern) - 1 + index)[::-1]
+
+_FIND_BLOCK_SIZE = 1 << 12
+_FIND_MAX_BLOCK_SIZE = 1 << 22
+
+def _find_range(x, start, direction, inclusive, pattern):
+    """Returns the range of pattern start positions [first, last) (forwards) or (last, first] (backwards)"""
     if not hasattr(pattern, '__iter__'):
         pattern = [pattern]
-
     pattern = np.array(pattern)
-    x = np.array(x)
-
+    x = np.asarray(x)
     pattern_length = len(pattern)
-    if direction == 'forward' or direction == 'forwards' or direction is True:
+    forward = direction == 'forward' or direction == 'forwards' or direction is True
+    if forward:
         if start is None:
             start = 0
-        for i in range(start, len(x) - pattern_length + 1):
-            if (x[i] == pattern[0]) and ((i == start and inclusive is True) or (i != start)) and np.all(x[i:i+pattern_length] == pattern): 
-                return i
-    else:
-        if start is None:
-            start = len(x) - 1
-        for i in range(start, -1 + pattern_length - 1, -1):
-            if (x[i] == pattern[-1]) and ((i == start and inclusive is True) or (i != start)) and np.all(x[i-pattern_length+1:i+1] == pattern):
-                return i
-    return None  # Not found
+        first = start if inclusive is True else start + 1
+        return x, pattern, first, len(x) - pattern_length + 1, forward
+    if start is None:
+        start = len(x) - 1
+    first = min(start if inclusive is True else start - 1, len(x) - 1) - pattern_length + 1
+    return x, pattern, first, -1, forward
+
+def _find_matches(x, pattern, begin, end):
+    """Returns a boolean mask of the positions in [begin, end) at which pattern starts in x"""
+    if x.dtype == bool and len(pattern) == 1 and pattern[0] == True:
+        return x[begin:end]  # Most common case, no comparison needed
+    matches = x[begin:end] == pattern[0]
+    for i in range(1, len(pattern)):
+        matches &= x[begin + i:end + i] == pattern[i]
+    return matches
 
 
 def nargout():
@@ -145,7 +372,7 @@ def nargout():
         return 0
     return 1
 
-def write_csv(x, filename, format='short', id=None, measurement_axis=None):
+def write_csv(x, filename, format='short', id=None, measurement_axis=None, chunk_size=1 << 20):
     """Write the contents of a numpy array to a CSV file
 
     In the simplest case, data is an MxN data array containing N repeated measures
@@ -164,8 +391,101 @@ def write_csv(x, filename, format='short', id=None, measurement_axis=None):
     redefined.
 
     It is also possible to pass the ID for each subject (as a list).
-    """
 
+    The rows are formatted and written in chunks of about chunk_size values, so memory use
+    stays bounded for large tables. See write_columns for a (much faster) binary output.
+    """
+    names, chunks = _table(x, format, id, measurement_axis, chunk_size)
+    with open(filename, "w") as fp:
+        fp.write(", ".join(names) + "\n")
+        for subjects, group_number, values in chunks:
+            # All the values of a subject are formatted at once, the id (\0) is filled in after
+            if group_number is None:
+                prefix = '\0,  ' if 'short' in format else '\0, '
+            else:
+                prefix = '\0, {:d}, '.format(group_number)
+            if 'short' in format:
+                row_format = prefix + ", ".join(['%f'] * values.shape[1]) + '\n'
+            else:
+                row_format = ''.join([prefix + '{:d}, %f\n'.format(i) for i in range(0, values.shape[1])])
+            fp.write(''.join([(row_format % tuple(row)).replace('\0', str(subject))
+                              for subject, row in zip(subjects.tolist(), values.tolist())]))
+
+def write_columns(x, directory, format='long', id=None, measurement_axis=None, chunk_size=1 << 20):
+    """Write the contents of a numpy array to a directory of binary columns
+
+    Takes the same arguments as write_csv (the default format is 'long') and writes the same
+    table, column by column: each column is a raw little-endian binary file (column_<index>.bin)
+    and columns.json describes the columns (name, file, numpy dtype) and the number of rows.
+    The group and measure_id columns are int32, the ids and measurements float64. Non numeric
+    ids are stored as int32 codes into the 'levels' of the id column (a factor).
+    In R, a column is read with readBin(file, 'double' (or 'integer'), n=rows, size=8 (or 4)).
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    names, chunks = _table(x, format, id, measurement_axis, chunk_size)
+    files = [open(os.path.join(directory, 'column_{:d}.bin'.format(i)), 'wb') for i in range(len(names))]
+    grouped = isinstance(x, list)
+    dtypes = ['<f8'] * len(names)
+    if grouped:
+        dtypes[1] = '<i4'
+    if 'short' not in format:
+        dtypes[-2] = '<i4'
+    levels = {}
+    rows = 0
+    try:
+        for subjects, group_number, values in chunks:
+            if 'short' in format:
+                columns = [subjects] + [values[:, i] for i in range(0, values.shape[1])]
+            else:
+                columns = [np.repeat(subjects, values.shape[1]), np.tile(np.arange(0, values.shape[1]), values.shape[0]),
+                           values.ravel()]
+            if grouped:
+                columns.insert(1, np.full(len(columns[0]), group_number))
+            for i, column in enumerate(columns):
+                if i == 0 and column.dtype.kind not in 'biuf':
+                    dtypes[0] = '<i4'
+                    column = np.array([levels.setdefault(value, len(levels)) for value in column.tolist()])
+                column.astype(dtypes[i]).tofile(files[i])
+            rows = rows + len(columns[0])
+    finally:
+        for fp in files:
+            fp.close()
+    description = {'rows': rows, 'columns': []}
+    for i, name in enumerate(names):
+        column = {'name': name, 'file': 'column_{:d}.bin'.format(i), 'dtype': dtypes[i]}
+        if i == 0 and len(levels) > 0:
+            column['levels'] = [str(level) for level in levels]
+        description['columns'].append(column)
+    with open(os.path.join(directory, 'columns.json'), 'w') as fp:
+        json.dump(description, fp, indent=1)
+
+def read_columns(directory):
+    """Reads a table written by write_columns
+
+    :return: A dictionary of column name -> memory-mapped numpy array (the id codes are
+    replaced by their levels)
+    """
+    with open(os.path.join(directory, 'columns.json'), 'r') as fp:
+        description = json.load(fp)
+    table = {}
+    for column in description['columns']:
+        if description['rows'] == 0:
+            values = np.zeros(0, dtype=column['dtype'])
+        else:
+            values = np.memmap(os.path.join(directory, column['file']), dtype=column['dtype'], mode='r',
+                               shape=(description['rows'],))
+        if 'levels' in column:
+            values = np.array(column['levels'])[values]
+        table[column['name']] = values
+    return table
+
+def _table(x, format, id, measurement_axis, chunk_size):
+    """Returns the column names of the table written by write_csv and a generator of its rows
+
+    The generator yields chunks of about chunk_size values, as (ids, group number (None without
+    groups), values) where values is a (subjects x measures) array.
+    """
     # Ensure all inputs are the same size
     if isinstance(x, list) and isinstance(x[0], list):
         x = [np.array(x[i]) for i in range(0, len(x))]
@@ -192,41 +512,27 @@ def write_csv(x, filename, format='short', id=None, measurement_axis=None):
             if x[i].shape[1] != num_measures:
                 raise RuntimeError('Number of measures is inconsistent across groups')
 
-    fp = open(filename, "w")
-    # Write out the header
-    fp.write('id, ')
-    if isinstance(x, list):
-        fp.write('group, ')
+    grouped = isinstance(x, list)
+    names = ['id'] + (['group'] if grouped else [])
     if 'short' in format:
         if measurement_axis is not None:
-            fp.write(", ".join(measurement_axis))
-        else:
-            fp.write(", ".join(['measure_{:d}'.format(i) for i in range(0, num_measures)]))
-    else:
-        fp.write("measure_id, ")
-        fp.write("dependent")
-    fp.write("\n")
-
-    if 'short' in format:
-        if isinstance(x, list):
-            for group_number in range(0, len(x)):
-                for subject_number in range(0, x[group_number].shape[0]):
-                    fp.write('{:s}, {:s}, '.format(str(id[group_number][subject_number]), str(group_number)))
-                    fp.write(", ".join(['{:f}'.format(x[group_number][subject_number, i]) for i in range(0, num_measures)]))
-                    fp.write("\n")
+            names = names + list(measurement_axis)
         else:
-            for subject_number in range(0, x.shape[0]):
-                fp.write('{:s},  '.format(str(id[subject_number])))
-                fp.write(", ".join(['{:f}'.format(x[subject_number, i]) for i in range(0, num_measures)]))
-                fp.write("\n")
+            names = names + ['measure_{:d}'.format(i) for i in range(0, num_measures)]
     else:
-        if isinstance(x, list):
-            for group_number in range(0, len(x)):
-                for subject_number in range(0, x[group_number].shape[0]):
-                    for measure_number in range(0, num_measures):
-                        fp.write('{:s}, {:s}, {:d}, {:f}\n'.format(str(id[group_number][subject_number]), str(group_number), measure_number, x[group_number][subject_number, measure_number]))
-        else:
-            for subject_number in range(0, x.shape[0]):
-                    for measure_number in range(0, num_measures):
-                        fp.write('{:s}, {:d}, {:f}\n'.format(str(id[subject_number]), measure_number, x[subject_number, measure_number]))
-    fp.close()
+        names = names + ['measure_id', 'dependent']
+
+    def chunks():
+        groups = x if grouped else [x]
+        ids = id if grouped else [id]
+        numeric_ids = all(np.asarray(i).dtype.kind in 'biuf' for i in ids)
+        rows_per_chunk = max(1, chunk_size // max(num_measures, 1))
+        for group_number in range(0, len(groups)):
+            data = np.asarray(groups[group_number])
+            group_id = np.asarray(ids[group_number])
+            if not numeric_ids:
+                group_id = group_id.astype(str)  # Consistent ids across groups
+            for begin in range(0, data.shape[0], rows_per_chunk):
+                yield (group_id[begin:begin + rows_per_chunk], group_number if grouped else None,
+                       data[begin:begin + rows_per_chunk])
+    return names, chunks()